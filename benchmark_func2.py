@@ -0,0 +1,281 @@
+import io
+import time
+import contextlib
+import numpy as np
+import pandas as pd
+from support_func2 import geo_distances, geo_distance_matrix, calculate_sse, create_distance_matrix, ODMatrix
+from models2 import (solve_tsp, solve_tsp_numpy, solve_cvrp, initial_kmeans_clustering, clustering_kmeans, capacitated_kmeans,
+                     cluster_locations_by_id, solve_tsp_parallel)
+
+# Wall time of the best run out of `repeats`
+def _best_time(func, repeats):
+    times = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+#DISTANCES: accuracy/speed of the batched engine against geopy
+
+def benchmark_distances(df, n_points=None, repeats=3):
+
+    points = df[['latitude', 'longitude']].to_numpy()
+    if n_points is not None:
+        points = points[:n_points]
+
+    # Point-to-centroid (mean location) and point-to-point (shuffled pairs) distances
+    rng = np.random.default_rng(0)
+    cases = {
+        'point-to-centroid': points.mean(axis=0),
+        'point-to-point': points[rng.permutation(len(points))],
+    }
+
+    rows = []
+    for case, centers in cases.items():
+        geopy_time, reference = _best_time(lambda: geo_distances(points, centers, 'geopy'), 1)
+        rows.append({'case': case, 'method': 'geopy', 'points': len(points), 'seconds': geopy_time,
+                     'speedup': 1.0, 'max_abs_error_km': 0.0, 'mean_rel_error': 0.0})
+
+        for method in ['geodesic', 'haversine']:
+            seconds, distances = _best_time(lambda: geo_distances(points, centers, method), repeats)
+            abs_error = np.abs(distances - reference)
+            rel_error = abs_error[reference > 0] / reference[reference > 0]
+            rows.append({'case': case, 'method': method, 'points': len(points), 'seconds': seconds,
+                         'speedup': geopy_time / seconds,
+                         'max_abs_error_km': abs_error.max(),
+                         'mean_rel_error': rel_error.mean() if len(rel_error) else 0.0})
+
+    return pd.DataFrame(rows)
+
+# Random cluster of n locations around a center, as a haversine distance matrix (km)
+def random_cluster_matrix(n, center=(45.46, 9.19), spread=0.3, seed=0):
+    rng = np.random.default_rng(seed)
+    points = np.asarray(center) + rng.uniform(-spread, spread, size=(n, 2))
+    return geo_distance_matrix(points, method='haversine')
+
+#TSP: Python lambda transit callback vs matrix registration
+
+def benchmark_tsp_transit(sizes=(25, 50, 100, 200), scale=1000, time_limit=None, repeats=1):
+
+    rows = []
+    for n in sizes:
+        distance_matrix = random_cluster_matrix(n)
+        cluster_locations = list(range(n))
+        for transit in ['callback', 'matrix']:
+            seconds, result = _best_time(lambda: solve_tsp(distance_matrix, cluster_locations, time_limit=time_limit,
+                                                           verbose=False, transit=transit, scale=scale), repeats)
+            rows.append({'cluster_size': n, 'transit': transit, 'seconds': seconds,
+                         'total_distance': result['total_distance']})
+
+    results = pd.DataFrame(rows)
+    timing = results.pivot(index='cluster_size', columns='transit', values='seconds')
+    timing['speedup'] = timing['callback'] / timing['matrix']
+    return results, timing
+
+#KMEANS: full-batch vs mini-batch initial clustering
+
+# Resample the POS locations with a small jitter to reach n points
+def resample_locations(df, n, jitter=0.01, seed=0):
+    rng = np.random.default_rng(seed)
+    sample = df.iloc[rng.integers(0, len(df), n)].reset_index(drop=True)
+    sample[['latitude', 'longitude']] += rng.normal(0, jitter, size=(n, 2))
+    sample['location_id'] = np.arange(1, n + 1)
+    return sample
+
+def benchmark_kmeans_modes(df, sizes=(3000, 30000, 300000), n_clusters=50, conv='max_iter', random='fixed',
+                           chunk_size=1024, repeats=1):
+
+    rows = []
+    for n in sizes:
+        data = resample_locations(df, n)
+        for kmeans_mode in ['batch', 'minibatch']:
+            seconds, (clustered, _) = _best_time(lambda: initial_kmeans_clustering(data.copy(), n_clusters, conv, random,
+                                                                                  kmeans_mode, chunk_size), repeats)
+            rows.append({'points': n, 'kmeans_mode': kmeans_mode, 'seconds': seconds,
+                         'sse': calculate_sse(clustered, 'haversine')})
+
+    results = pd.DataFrame(rows)
+    comparison = results.pivot(index='points', columns='kmeans_mode', values=['seconds', 'sse'])
+    comparison['speedup'] = comparison[('seconds', 'batch')] / comparison[('seconds', 'minibatch')]
+    comparison['sse_ratio'] = comparison[('sse', 'minibatch')] / comparison[('sse', 'batch')]
+    return results, comparison
+
+#CLUSTERING: KMeans + repair heuristics vs capacitated k-means
+
+def _constraint_report(clustered, distance_method):
+    points = clustered[['latitude', 'longitude']].to_numpy()
+    centers = np.array(clustered['cluster_center'].tolist(), dtype=np.float64)
+    radius = pd.Series(geo_distances(points, centers, distance_method), index=clustered.index)
+    groups = clustered.groupby('cluster')
+    return {'clusters': clustered['cluster'].nunique(),
+            'max_quantity': groups['quantity'].sum().max(),
+            'max_points': groups.size().max(),
+            'max_radius': radius.groupby(clustered['cluster']).max().max(),
+            'sse': calculate_sse(clustered, distance_method)}
+
+def benchmark_clustering_engines(df, initial_clusters=5, max_radius=60, max_quantity=300, max_points=400,
+                                 radius_splitting='double', distance_method='haversine', repeats=1):
+
+    engines = {
+        'kmeans + full repair': lambda: clustering_kmeans(df.copy(), initial_clusters, max_radius, max_quantity, max_points,
+                                                          'max_iter', 'fixed', radius_splitting, distance_method, 'full')[2],
+        'kmeans + incremental repair': lambda: clustering_kmeans(df.copy(), initial_clusters, max_radius, max_quantity, max_points,
+                                                                 'max_iter', 'fixed', radius_splitting, distance_method, 'incremental')[2],
+        'capacitated kmeans': lambda: capacitated_kmeans(df, initial_clusters, max_radius, max_quantity, max_points,
+                                                         'fixed', distance_method)[0],
+    }
+
+    rows = []
+    for engine, run in engines.items():
+        # The engines print their progress, keep the benchmark output readable
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                seconds, clustered = _best_time(run, repeats)
+        except ValueError as error:
+            # e.g. a repair split asking for more sub-clusters than the cluster has points
+            rows.append({'engine': engine, 'error': str(error)})
+            continue
+        rows.append({'engine': engine, 'seconds': seconds, **_constraint_report(clustered, distance_method)})
+
+    return pd.DataFrame(rows)
+
+# OD frame (rows location_id, columns str(location_id)) from coordinates, depot as location 0
+def geo_od_matrix(df, depot=(45.46, 9.19), distance_method='haversine'):
+    points = np.vstack([depot, df[['latitude', 'longitude']].to_numpy()])
+    location_ids = [0] + df['location_id'].tolist()
+    return pd.DataFrame(geo_distance_matrix(points, method=distance_method), index=location_ids,
+                        columns=[str(location_id) for location_id in location_ids])
+
+#ROUTING: split clusters by capacity then TSP vs one CVRP over the area
+
+def benchmark_cvrp(df, n_points=100, vehicle_capacity=30, depot=(45.46, 9.19), time_limit=None, scale=1000,
+                   distance_method='haversine'):
+
+    # The n_points locations closest to the depot, depot as location 0
+    distances = geo_distances(df[['latitude', 'longitude']].to_numpy(), depot, distance_method)
+    area = df.iloc[np.argsort(distances)[:n_points]].reset_index(drop=True)
+    od_matrix = geo_od_matrix(area, depot, distance_method)
+    location_ids = od_matrix.index.tolist()
+
+    def split_then_tsp():
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, _, final_cluster = clustering_kmeans(area.copy(), 1, np.inf, vehicle_capacity, n_points, 'max_iter', 'fixed',
+                                                    'double', distance_method, 'incremental')
+        results = [solve_tsp(create_distance_matrix(cluster_locations, od_matrix), cluster_locations,
+                             time_limit=time_limit, verbose=False, scale=scale)
+                   for cluster_locations in cluster_locations_by_id(final_cluster).values()]
+        return sum(result['total_distance'] for result in results), len(results)
+
+    split_seconds, (split_distance, n_routes) = _best_time(split_then_tsp, 1)
+
+    def cvrp():
+        demands = np.concatenate([[0.0], area['quantity'].to_numpy()])
+        return solve_cvrp(od_matrix.to_numpy(), location_ids, demands, vehicle_capacity, n_routes + 1,
+                          time_limit=time_limit, verbose=False, scale=scale)
+
+    cvrp_seconds, result = _best_time(cvrp, 1)
+
+    return pd.DataFrame([
+        {'mode': 'split + TSP', 'seconds': split_seconds, 'routes': n_routes, 'total_distance': split_distance,
+         'feasible': True},
+        # An infeasible CVRP has no distance (NaN), it never ranks as the shortest
+        {'mode': 'CVRP', 'seconds': cvrp_seconds, 'routes': len(result['routes']),
+         'total_distance': result['total_distance'] if result['feasible'] else np.nan, 'feasible': result['feasible']},
+    ])
+
+#TSP SEARCH: distance-vs-time curves per search strategy
+
+TSP_STRATEGIES = {
+    'cheapest arc': {'first_solution': 'PATH_CHEAPEST_ARC'},
+    'savings': {'first_solution': 'SAVINGS'},
+    'cheapest arc + GLS': {'first_solution': 'PATH_CHEAPEST_ARC', 'metaheuristic': 'GUIDED_LOCAL_SEARCH'},
+    'cheapest arc + tabu': {'first_solution': 'PATH_CHEAPEST_ARC', 'metaheuristic': 'TABU_SEARCH'},
+    'cheapest arc + annealing': {'first_solution': 'PATH_CHEAPEST_ARC', 'metaheuristic': 'SIMULATED_ANNEALING'},
+}
+
+def benchmark_tsp_search(df, strategies=TSP_STRATEGIES, n_clusters=3, initial_clusters=5, max_radius=60, max_quantity=300,
+                         max_points=400, depot=(45.46, 9.19), time_limit=5, scale=1000, distance_method='haversine'):
+    """
+    Cluster spatial_data.csv, then solve the first n_clusters clusters' TSP (depot first) with every strategy.
+
+    Returns the curves (strategy, cluster, seconds, distance: best route so far at every solution found)
+    and a summary per strategy: final distance, time to reach it, and gap to the best strategy.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, _, final_cluster = clustering_kmeans(df.copy(), initial_clusters, max_radius, max_quantity, max_points,
+                                                'max_iter', 'fixed', 'double', distance_method, 'incremental')
+
+    curves = []
+    for cluster_id, cluster_data in list(final_cluster.groupby('cluster'))[:n_clusters]:
+        points = np.vstack([depot, cluster_data[['latitude', 'longitude']].to_numpy()])
+        distance_matrix = geo_distance_matrix(points, method=distance_method)
+        cluster_locations = [0] + cluster_data['location_id'].tolist()
+
+        for strategy, options in strategies.items():
+            start = time.perf_counter()
+            best = [np.inf]
+
+            def record(cost):
+                best[0] = min(best[0], cost)
+                curves.append({'strategy': strategy, 'cluster': cluster_id, 'cluster_size': len(cluster_locations),
+                               'seconds': time.perf_counter() - start, 'distance': best[0]})
+
+            solve_tsp(distance_matrix, cluster_locations, time_limit=time_limit, verbose=False, scale=scale,
+                      on_solution=record, **options)
+
+    curves = pd.DataFrame(curves)
+    final = curves.groupby(['strategy', 'cluster']).last()
+    # Time at which every strategy first reached its final distance
+    reached = curves.merge(final['distance'].reset_index(), on=['strategy', 'cluster', 'distance'])
+    final['seconds_to_final'] = reached.groupby(['strategy', 'cluster'])['seconds'].min()
+    final['gap'] = final['distance'] / final.groupby('cluster')['distance'].transform('min') - 1
+    summary = final.groupby('strategy')[['distance', 'seconds', 'seconds_to_final', 'gap']].mean()
+    return curves, summary.sort_values('gap')
+
+#TSP ENGINES: OR-Tools vs the NumPy heuristic by cluster size
+
+def benchmark_tsp_engines(sizes=(5, 10, 20, 50, 100, 200), scale=1000, repeats=3):
+
+    rows = []
+    for n in sizes:
+        distance_matrix = random_cluster_matrix(n, seed=n)
+        cluster_locations = list(range(n))
+        engines = {
+            'ortools': lambda: solve_tsp(distance_matrix, cluster_locations, verbose=False, scale=scale),
+            'numpy': lambda: solve_tsp_numpy(distance_matrix, cluster_locations, verbose=False),
+        }
+        for engine, run in engines.items():
+            seconds, result = _best_time(run, repeats)
+            rows.append({'cluster_size': n, 'engine': engine, 'seconds': seconds, 'total_distance': result['total_distance']})
+
+    results = pd.DataFrame(rows)
+    comparison = results.pivot(index='cluster_size', columns='engine', values=['seconds', 'total_distance'])
+    comparison['speedup'] = comparison[('seconds', 'ortools')] / comparison[('seconds', 'numpy')]
+    comparison['distance_ratio'] = comparison[('total_distance', 'numpy')] / comparison[('total_distance', 'ortools')]
+    return results, comparison
+
+#ROUTE CACHE: constraint sweep, only clusters whose membership changed are solved
+
+def constraint_sweep(max_radius=(40, 50, 60, 70, 80), max_quantity=(250, 300), max_points=(350, 400)):
+    return [{'max_radius': radius, 'max_quantity': quantity, 'max_points': points}
+            for radius in max_radius for quantity in max_quantity for points in max_points]
+
+def benchmark_route_sweep(df, cache, sweep=None, initial_clusters=5, depot=(45.46, 9.19), time_limit=None,
+                          distance_method='haversine', engine='ortools', max_workers=None):
+
+    od_matrix = ODMatrix.from_frame(geo_od_matrix(df, depot, distance_method))
+    rows = []
+    for setting in sweep or constraint_sweep():
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, _, final_cluster = clustering_kmeans(df.copy(), initial_clusters, setting['max_radius'], setting['max_quantity'],
+                                                    setting['max_points'], 'max_iter', 'fixed', 'double', distance_method, 'incremental')
+        hits, misses = cache.hits, cache.misses
+        seconds, routes = _best_time(lambda: dict(solve_tsp_parallel(final_cluster, od_matrix, max_workers=max_workers,
+                                                                     time_limit=time_limit, verbose=False, engine=engine,
+                                                                     cache=cache)), 1)
+        rows.append({**setting, 'clusters': len(routes), 'cached': cache.hits - hits, 'solved': cache.misses - misses,
+                     'route_seconds': seconds, 'total_distance': sum(result['total_distance'] for result in routes.values())})
+
+    return pd.DataFrame(rows)
@@ -0,0 +1,131 @@
+import os
+import json
+import pickle
+import hashlib
+import numpy as np
+
+# Stable hash of arrays and JSON-like settings, used as cache key
+def fingerprint(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(str((part.dtype.str, part.shape)).encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+        digest.update(b'|')
+    return digest.hexdigest()
+
+class DiskLRUCache:
+    """
+    Pickled values on disk, one file per key.
+
+    A hit refreshes the file's modification time; when the directory grows over max_bytes
+    the least recently used entries are deleted. hits/misses count the lookups.
+
+    The directory size is scanned once and then tracked in memory, so a set() costs a single
+    stat; the directory is only listed again when the tracked total goes over max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 ** 2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = None if max_bytes is None else sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.pkl')
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return default
+        os.utime(path)  # most recently used
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        # Write then rename, so a concurrent reader never sees half a file
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.max_bytes is None:
+            os.replace(tmp_path, path)
+            return
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        self.total_bytes += os.path.getsize(tmp_path) - replaced
+        os.replace(tmp_path, path)
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+        return entries
+
+    def _evict(self):
+        # Fresh scan: also picks up entries written by other processes sharing the directory
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass  # already evicted by another process
+            total -= size
+        self.total_bytes = total
+
+    def stats(self):
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(entries), 'bytes': sum(size for _, size, _ in entries)}
+
+#FORECASTS
+
+def forecast_key(values, settings, forecast_steps):
+    # Cleaned weekly series + model settings + horizon
+    return fingerprint('forecast', np.asarray(values, dtype=np.float64), settings, forecast_steps)
+
+class ForecastCache(DiskLRUCache):
+
+    def __init__(self, directory='./Data/forecast_model_cache', max_bytes=256 * 1024 ** 2):
+        super().__init__(directory, max_bytes)
+
+    def get_forecast(self, values, settings, forecast_steps):
+        return self.get(forecast_key(values, settings, forecast_steps))
+
+    def set_forecast(self, values, settings, forecast_steps, result):
+        self.set(forecast_key(values, settings, forecast_steps), result)
+
+#ROUTES
+
+def route_key(location_ids, depot_id, od_version, settings):
+    # Cluster membership (order-free) + depot + OD matrix version + solver settings
+    members = sorted(str(location_id) for location_id in location_ids if location_id != depot_id)
+    return fingerprint('route', members, str(depot_id), od_version, settings)
+
+class RouteCache(DiskLRUCache):
+
+    def __init__(self, directory='./Data/route_cache', max_bytes=256 * 1024 ** 2):
+        super().__init__(directory, max_bytes)
+
+    def get_route(self, location_ids, depot_id, od_version, settings):
+        return self.get(route_key(location_ids, depot_id, od_version, settings))
+
+    def set_route(self, location_ids, depot_id, od_version, settings, result):
+        self.set(route_key(location_ids, depot_id, od_version, settings), result)
@@ -1,12 +1,31 @@
 
-from pmdarima import auto_arima
+from pmdarima import auto_arima, ARIMA
 from sklearn.model_selection import TimeSeriesSplit
 from sklearn.metrics import mean_absolute_error, mean_squared_error
+from statsmodels.stats.diagnostic import acorr_ljungbox
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 import numpy as np
 import pandas as pd
 import warnings
+import time
+import json
+import os
+from cache_func import forecast_key
+from support_func import week_keys
+
+AUTO_ARIMA_SETTINGS = {'model': 'auto_arima', 'seasonal': False, 'stepwise': True}
+
+def model_auto_arima(df_3719_week, forecast_steps, cache=None):
+    # With a ForecastCache, an unchanged series returns the stored forecast without refitting
+    if cache is not None:
+        cached = cache.get_forecast(df_3719_week['quantity1'], AUTO_ARIMA_SETTINGS, forecast_steps)
+        if cached is not None:
+            print("Forecast for the next periods (cached):")
+            print(cached['forecast'])
+            print(f"In-sample RMSE: {cached['rmse_in_sample']:.2f}")
+            print(cached['summary'])
+            return cached['forecast']
 
-def model_auto_arima(df_3719_week, forecast_steps):
     with warnings.catch_warnings():
         # Filter only ValueWarning and FutureWarning messages related to index
         warnings.filterwarnings("ignore", message="No supported index is available", category=UserWarning)
@@ -20,8 +39,7 @@ def model_auto_arima(df_3719_week, forecast_steps):
                            suppress_warnings=True, 
                            stepwise=True)   
             
-        # Fit the model
-        model.fit(df_3719_week['quantity1'])
+        # auto_arima returns the best model already fitted on the series
             
         # Forecast the next few time periods (e.g., 5 steps forward)
         forecast = model.predict(n_periods=forecast_steps)
@@ -35,44 +53,270 @@ def model_auto_arima(df_3719_week, forecast_steps):
         rmse_in_sample = np.sqrt(mean_squared_error(df_3719_week['quantity1'], in_sample_forecast))
         print(f'In-sample RMSE: {rmse_in_sample:.2f}')
         print(model.summary())
+
+        if cache is not None:
+            cache.set_forecast(df_3719_week['quantity1'], AUTO_ARIMA_SETTINGS, forecast_steps,
+                               {'forecast': forecast, 'rmse_in_sample': rmse_in_sample, 'summary': str(model.summary())})
         return forecast
 
-def model_auto_arima_cross(df_3719_week, forecast_steps, splitting):
+def _cv_fold(fold, train, test, order=None, with_intercept=True):
+    # Fit on the train window (full auto_arima search, or only the given order) and score the test window
+    row = {'fold': fold, 'train_size': len(train), 'test_size': len(test)}
+    start = time.perf_counter()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            if order is None:
+                model = auto_arima(train,
+                                   seasonal=False,
+                                   trace=False,
+                                   error_action='ignore',
+                                   suppress_warnings=True,
+                                   stepwise=True)
+            else:
+                model = ARIMA(order=order, with_intercept=with_intercept, suppress_warnings=True).fit(train)
+
+            # Forecast for the length of the test set
+            forecast = model.predict(n_periods=len(test))
+            row['p'], row['d'], row['q'] = model.order
+            row['rmse'] = np.sqrt(mean_squared_error(test, forecast))
+            row['mae'] = mean_absolute_error(test, forecast)
+            row['error'] = None
+        except Exception as e:
+            row['error'] = repr(e)
+    row['fit_seconds'] = time.perf_counter() - start
+    return row
+
+def model_auto_arima_cross(df_3719_week, forecast_steps, splitting, mode='full', max_workers=1):
+    """
+    TimeSeriesSplit cross-validation of auto_arima, one row per fold (order, RMSE, MAE, fit time).
+
+    mode='full' runs the stepwise search on every fold, mode='shared' selects the order once on the
+    largest training window and only refits the parameters on each fold.
+    Folds run in max_workers processes (inline if 1).
+    """
     # Ensure 'delivery_date' is a datetime index (remove if already confirmed)
     df_3719_week.index = pd.DatetimeIndex(df_3719_week.index)
+    values = df_3719_week['quantity1'].to_numpy(dtype=np.float64)
     
     # Initialize TimeSeriesSplit for cross-validation
     tscv = TimeSeriesSplit(n_splits=splitting)
-    
-    # Store RMSE scores for each fold
-    rmse_scores = []
-    
-    # Cross-validation loop
-    for train_index, test_index in tscv.split(df_3719_week):
-        # Split the data into train and test sets for the current fold
-        train, test = df_3719_week.iloc[train_index], df_3719_week.iloc[test_index]
-        
-        # Fit auto_arima on the training set
-        model = auto_arima(train['quantity1'], 
-                           seasonal=False, 
-                           trace=True,
-                           error_action='ignore',
-                           suppress_warnings=True,
-                           stepwise=True)
-        
-        # Forecast for the length of the test set
-        forecast = model.predict(n_periods=len(test))
-        # Display the forecast
-        print("Forecast for the next periods:")
-        print(forecast)
-        
-        # Calculate RMSE for the current fold
-        rmse = np.sqrt(mean_squared_error(test['quantity1'], forecast))
-        rmse_scores.append(rmse)
-        print(f'Fold RMSE: {rmse:.2f}')
-    
-    # Calculate the average RMSE across all folds
-    average_rmse = np.mean(rmse_scores)
-    print(f'Average RMSE across all folds: {average_rmse:.2f}')
-    
+    splits = list(tscv.split(values))
+
+    order, with_intercept = None, True
+    search_seconds = 0.0
+    if mode == 'shared':
+        start = time.perf_counter()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            model = auto_arima(values[splits[-1][0]],
+                               seasonal=False,
+                               trace=False,
+                               error_action='ignore',
+                               suppress_warnings=True,
+                               stepwise=True)
+        order, with_intercept = model.order, model.with_intercept
+        search_seconds = time.perf_counter() - start
+    elif mode != 'full':
+        raise ValueError("mode must be 'full' or 'shared'")
+
+    folds = [(fold, values[train_index], values[test_index], order, with_intercept)
+             for fold, (train_index, test_index) in enumerate(splits)]
+
+    if max_workers == 1:
+        rows = [_cv_fold(*args) for args in folds]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            rows = list(executor.map(_cv_fold, *zip(*folds)))
+
+    results = pd.DataFrame(rows)
+    results.attrs['mode'] = mode
+    results.attrs['order_search_seconds'] = search_seconds
+    return results
+
+def _cv_location(location_id, values, splitting, mode):
+    frame = pd.DataFrame({'quantity1': values}, index=pd.RangeIndex(len(values)))
+    try:
+        results = model_auto_arima_cross(frame, None, splitting, mode=mode, max_workers=1)
+    except Exception as e:
+        # Fewer than splitting+1 weeks, or a failed shared order search: one error row, the batch goes on
+        results = pd.DataFrame([{'fold': None, 'train_size': len(values), 'error': repr(e)}])
+    results.insert(0, 'location_id', location_id)
+    return results
+
+# Cross-validation of every location_id, locations spread over the worker processes
+def cross_validate_all_locations(weekly_data, splitting, mode='shared', max_workers=None, value_col='quantity1'):
+    series = list(weekly_series(weekly_data, value_col))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_cv_location, [location_id for location_id, _ in series],
+                                    [values for _, values in series],
+                                    [splitting] * len(series), [mode] * len(series)))
+    return pd.concat(results, ignore_index=True)
+
+#BATCH FORECASTING: every location_id, fitted in parallel
+
+# Weekly series of every location, ordered by (iso_year,) week
+def weekly_series(weekly_data, value_col='quantity1'):
+    ordered = weekly_data.sort_values(['location_id'] + week_keys(weekly_data))
+    for location_id, group in ordered.groupby('location_id', sort=False):
+        yield location_id, group[value_col].to_numpy(dtype=np.float64)
+
+def _chunks(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def ljung_box_pvalue(residuals, lags=10):
+    if len(residuals) < 3:
+        return np.nan
+    lags = max(1, min(lags, len(residuals) // 2))
+    return float(acorr_ljungbox(residuals, lags=[lags])['lb_pvalue'].iloc[0])
+
+#Registry of the selected orders and parameters, to warm start the weekly refits
+
+class ArimaRegistry:
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, location_id):
+        return self.entries.get(str(location_id))
+
+    def update(self, location_id, entry):
+        self.entries[str(location_id)] = entry
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump(self.entries, f)
+
+def model_state(model, n_obs):
+    return {'order': list(model.order),
+            'with_intercept': bool(model.with_intercept),
+            'params': np.asarray(model.params()).tolist(),
+            'aic': float(model.aic()),
+            'n_obs': n_obs}
+
+def refit_arima(values, entry, aic_drift=0.1, lb_alpha=0.05):
+    # Refit only the registered order, starting from the registered parameters.
+    # None if the fit fails or drifted: AIC per observation moved by more than aic_drift (relative)
+    # or residuals are no longer white noise (Ljung-Box p-value below lb_alpha)
+    try:
+        model = ARIMA(order=tuple(entry['order']),
+                      with_intercept=entry['with_intercept'],
+                      start_params=entry['params'],
+                      suppress_warnings=True).fit(values)
+    except Exception:
+        return None
+
+    previous_aic = entry['aic'] / entry['n_obs']
+    current_aic = model.aic() / len(values)
+    if abs(current_aic - previous_aic) > aic_drift * abs(previous_aic):
+        return None
+    if ljung_box_pvalue(model.resid()) < lb_alpha:
+        return None
+    return model
+
+def fit_arima_series(location_id, values, forecast_steps, entry=None, aic_drift=0.1, lb_alpha=0.05):
+    # One location: forecast, order/AIC and diagnostics as a flat row, warnings captured instead of printed.
+    # With a registry entry only its order is refitted, the full search runs if that fit drifted.
+    row = {'location_id': location_id, 'n_obs': len(values)}
+    state = None
+    start = time.perf_counter()
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        try:
+            model = refit_arima(values, entry, aic_drift, lb_alpha) if entry is not None else None
+            row['search'] = 'warm' if model is not None else 'full'
+            if model is None:
+                model = auto_arima(values,
+                                   seasonal=False,
+                                   trace=False,
+                                   error_action='ignore',
+                                   suppress_warnings=True,
+                                   stepwise=True)
+            forecast = model.predict(n_periods=forecast_steps)
+            in_sample_forecast = model.predict_in_sample()
+
+            row['p'], row['d'], row['q'] = model.order
+            row['aic'] = model.aic()
+            row['rmse_in_sample'] = np.sqrt(mean_squared_error(values, in_sample_forecast))
+            row['ljung_box_pvalue'] = ljung_box_pvalue(model.resid())
+            for step, value in enumerate(np.asarray(forecast), start=1):
+                row[f'forecast_{step}'] = value
+            row['error'] = None
+            state = model_state(model, len(values))
+        except Exception as e:
+            row['error'] = repr(e)
+
+    row['fit_seconds'] = time.perf_counter() - start
+    row['warnings'] = ' | '.join(sorted({str(w.message) for w in caught})) or None
+    return row, state
+
+def _fit_arima_chunk(chunk, forecast_steps, aic_drift, lb_alpha):
+    return [(location_id, fit_arima_series(location_id, values, forecast_steps, entry, aic_drift, lb_alpha))
+            for location_id, values, entry in chunk]
+
+def forecast_all_locations(weekly_data, forecast_steps, output_path=None, max_workers=None, chunk_size=50, value_col='quantity1',
+                           registry=None, aic_drift=0.1, lb_alpha=0.05, cache=None):
+    """
+    Fit auto_arima on the weekly series of every location_id, chunk_size locations per task.
+
+    At most 2 tasks per worker are in flight, so memory stays bounded whatever the number of locations.
+    Returns one row per location (order, AIC, diagnostics, forecast_1..forecast_n), also written
+    to output_path as Parquet if given.
+    With an ArimaRegistry, locations already registered are refitted on their previous order
+    (see refit_arima) and the registry is updated and saved at the end.
+    With a ForecastCache, locations whose series didn't change are served from the cache (search='cache').
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    settings = dict(AUTO_ARIMA_SETTINGS, warm_start=registry is not None, aic_drift=aic_drift, lb_alpha=lb_alpha)
+    rows = []
+    cache_keys = {}
+
+    def collect(futures):
+        for future in futures:
+            for location_id, (row, state) in future.result():
+                rows.append(row)
+                if registry is not None and state is not None:
+                    registry.update(location_id, state)
+                if cache is not None and row['error'] is None:
+                    cache.set(cache_keys.pop(location_id), {key: value for key, value in row.items() if key != 'location_id'})
+
+    def tasks():
+        for location_id, values in weekly_series(weekly_data, value_col):
+            if cache is not None:
+                key = forecast_key(values, settings, forecast_steps)
+                cached = cache.get(key)
+                if cached is not None:
+                    rows.append(dict(cached, location_id=location_id, search='cache'))
+                    continue
+                cache_keys[location_id] = key
+            yield location_id, values, registry.get(location_id) if registry is not None else None
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for chunk in _chunks(tasks(), chunk_size):
+            if len(pending) >= 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(_fit_arima_chunk, chunk, forecast_steps, aic_drift, lb_alpha))
+
+        collect(wait(pending).done)
+
+    if registry is not None:
+        registry.save()
 
+    results = pd.DataFrame(rows).sort_values('location_id').reset_index(drop=True)
+    if output_path is not None:
+        results.to_parquet(output_path, index=False)
+    return results
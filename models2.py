@@ -1,49 +1,63 @@
 
-from geopy.distance import geodesic
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 import pandas as pd
 import numpy as np
-from support_func2 import get_cluster_stats, get_cluster_stats_radius
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from support_func2 import get_cluster_stats, get_cluster_stats_radius, geo_distances, geo_distance_matrix, create_distance_matrix, ODMatrix, haversine_matrix_hubs, SpatialIndex
+from cache_func import fingerprint
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
 
 #CLUSTERING KMEANS (Starting)
 
 # Calculate the radius of a cluster
-def calculate_radius(cluster_points, center):
-    distances = [geodesic((lat, lon), center).km for lat, lon in cluster_points]
-    return max(distances) if distances else 0
+def calculate_radius(cluster_points, center, method='geodesic'):
+    distances = geo_distances(cluster_points, center, method)
+    return distances.max() if len(distances) else 0
 
 
 #Initial clusters
 
-def initial_kmeans_clustering(data, n_clusters, conv, random):
+# KMeans estimator for the conv/random options; kmeans_mode='minibatch' fits chunk_size points at a time
+def kmeans_model(n_clusters, conv, random, kmeans_mode='batch', chunk_size=1024):
 
     if conv=='max_iter':
-        if random=='fixed':
-            kmeans = KMeans(n_clusters=n_clusters, 
-                    random_state=0, #to allow reproducibility
-                    n_init=1,
-                    init='k-means++',
-                    max_iter=300)
-        else:
-            kmeans = KMeans(n_clusters=n_clusters, 
-                    n_init=10,
-                    init='k-means++',
-                    max_iter=300)
+        stopping = {'max_iter': 300}
     elif conv=='tol':
-        if random=='fixed':
-            kmeans = KMeans(n_clusters=n_clusters, 
-                    random_state=0, #to allow reproducibility
-                    init='k-means++',
-                    n_init=1,
-                    tol=300)
-        else:
-            kmeans = KMeans(n_clusters=n_clusters,
-                    init='k-means++',
-                    n_init=10,
-                    tol=300)
+        stopping = {'tol': 300}
+    else:
+        return None
+
+    if random=='fixed':
+        seeding = {'random_state': 0, 'n_init': 1} #to allow reproducibility
     else:
+        seeding = {'n_init': 10}
+
+    if kmeans_mode=='minibatch':
+        # No random re-seeding of small clusters: with dense city areas it throws good centers away
+        return MiniBatchKMeans(n_clusters=n_clusters, init='k-means++', batch_size=chunk_size, reassignment_ratio=0,
+                               **seeding, **stopping)
+    return KMeans(n_clusters=n_clusters, init='k-means++', **seeding, **stopping)
+
+# Mini-batch KMeans over an iterable of coordinate chunks (e.g. read_csv(chunksize=...)), one pass
+def streaming_kmeans(chunks, n_clusters, random, chunk_size=1024):
+
+    kmeans = kmeans_model(n_clusters, 'max_iter', random, 'minibatch', chunk_size)
+    pending = np.empty((0, 2))
+    for chunk in chunks:
+        pending = np.vstack([pending, np.asarray(chunk, dtype=np.float64)[:, :2]])
+        # The first partial_fit seeds the centers, it needs at least n_clusters points
+        if len(pending) >= max(chunk_size, n_clusters):
+            kmeans.partial_fit(pending)
+            pending = np.empty((0, 2))
+    if len(pending) and (hasattr(kmeans, 'cluster_centers_') or len(pending) >= n_clusters):
+        kmeans.partial_fit(pending)
+    return kmeans
+
+def initial_kmeans_clustering(data, n_clusters, conv, random, kmeans_mode='batch', chunk_size=1024):
+
+    kmeans = kmeans_model(n_clusters, conv, random, kmeans_mode, chunk_size)
+    if kmeans is None:
         print('Insert convergence condition.')
         return
     
@@ -121,7 +135,7 @@ def adjust_capacity_constraints(data, max_quantity, max_points):
     
     return adjusted_data
 
-def enforce_radius_constraint(data, max_radius, radius_splitting):
+def enforce_radius_constraint(data, max_radius, radius_splitting, distance_method='geodesic'):
 
     new_clusters = []
     new_centroids = []
@@ -132,7 +146,7 @@ def enforce_radius_constraint(data, max_radius, radius_splitting):
 
         # Check radius
         original_centroid = cluster_data['cluster_center'].iloc[0]
-        radius = calculate_radius(cluster_data[['latitude', 'longitude']].values, original_centroid)
+        radius = calculate_radius(cluster_data[['latitude', 'longitude']].values, original_centroid, distance_method)
         
         if radius > max_radius:
             print('cluster to split due to radius ',cluster_id, radius)
@@ -180,16 +194,129 @@ def enforce_radius_constraint(data, max_radius, radius_splitting):
     
     return adjusted_data
 
-def clustering_kmeans(data, initial_clusters, max_radius, max_quantity, max_points, conv, random, radius_splitting):
-    
-    # Initial Clustering
-    data1, centers1 = initial_kmeans_clustering(data, initial_clusters, conv, random)
+#Incremental repair: per-cluster aggregates in arrays, only the clusters split in the last pass are re-checked
+
+class ClusterState:
+
+    def __init__(self, data, distance_method='geodesic'):
+        self.coords = data[['latitude', 'longitude']].to_numpy(dtype=np.float64)
+        self.quantity = data['quantity'].to_numpy(dtype=np.float64)
+        self.labels = data['cluster'].to_numpy(dtype=np.int64).copy()
+        self.distance_method = distance_method
+
+        # Aggregates indexed by cluster number
+        n = int(self.labels.max()) + 1
+        self.points = np.bincount(self.labels, minlength=n)
+        self.quantity_sum = np.bincount(self.labels, weights=self.quantity, minlength=n)
+        self.max_radius = np.full(n, np.nan)  # NaN until computed
+        self.centers = np.full((n, 2), np.nan)
+        first_rows = data.drop_duplicates('cluster')
+        self.centers[first_rows['cluster'].to_numpy()] = np.array(first_rows['cluster_center'].tolist(), dtype=np.float64)
+
+        # Row positions of every cluster, grouped once
+        order = np.argsort(self.labels, kind='stable')
+        cluster_ids, starts = np.unique(self.labels[order], return_index=True)
+        self.members = dict(zip(cluster_ids.tolist(), np.split(order, starts[1:])))
+
+    def clusters(self):
+        return list(self.members)
+
+    def _grow(self, n):
+        # Make room for cluster numbers up to n - 1
+        extra = n - len(self.points)
+        if extra > 0:
+            self.points = np.concatenate([self.points, np.zeros(extra, dtype=self.points.dtype)])
+            self.quantity_sum = np.concatenate([self.quantity_sum, np.zeros(extra)])
+            self.max_radius = np.concatenate([self.max_radius, np.full(extra, np.nan)])
+            self.centers = np.concatenate([self.centers, np.full((extra, 2), np.nan)])
+
+    def radius(self, cluster_id):
+        # Max distance from the centroid, computed only once per cluster
+        if np.isnan(self.max_radius[cluster_id]):
+            members = self.members[cluster_id]
+            self.max_radius[cluster_id] = calculate_radius(self.coords[members], self.centers[cluster_id], self.distance_method)
+        return self.max_radius[cluster_id]
+
+    def split(self, cluster_id, n_subclusters):
+        members = self.members[cluster_id]
+        n_subclusters = min(n_subclusters, len(members))
+        sub_kmeans = KMeans(n_clusters=n_subclusters, random_state=0, n_init=1, init='k-means++', max_iter=300)
+        sub_labels = sub_kmeans.fit_predict(self.coords[members])
+        centers = sub_kmeans.cluster_centers_
+
+        # Sub-cluster 0 keeps the original number, the others get new ones
+        cluster_max_number = max(self.members)
+        new_ids = np.array([cluster_id] + list(range(cluster_max_number + 1, cluster_max_number + n_subclusters)))
+        self._grow(int(new_ids.max()) + 1)
+
+        self.labels[members] = new_ids[sub_labels]
+        self.points[new_ids] = np.bincount(sub_labels, minlength=n_subclusters)
+        self.quantity_sum[new_ids] = np.bincount(sub_labels, weights=self.quantity[members], minlength=n_subclusters)
+        self.max_radius[new_ids] = np.nan
+        self.centers[new_ids] = centers
+        for sub_cluster_id, new_id in enumerate(new_ids.tolist()):
+            self.members[new_id] = members[sub_labels == sub_cluster_id]
+
+        return new_ids.tolist()
+
+    def to_frame(self, data):
+        adjusted_data = data.copy()
+        adjusted_data['cluster'] = self.labels
+        adjusted_data['cluster_center'] = list(map(tuple, self.centers[self.labels]))
+        return adjusted_data
+
+def adjust_capacity_incremental(data, max_quantity, max_points):
+
+    state = ClusterState(data)
+    to_check = state.clusters()
+
+    while to_check:
+        changed = []
+        for cluster_id in to_check:
+            total_quantity = state.quantity_sum[cluster_id]
+            total_points = state.points[cluster_id]
+
+            # A single point over capacity can't be split any further
+            if (total_quantity > max_quantity or total_points > max_points) and total_points > 1:
+                print('cluster to split due to capacity ', cluster_id, total_points, total_quantity)
+                n_subclusters = int(max(total_quantity // max_quantity, total_points // max_points) + 1)
+                changed.extend(state.split(cluster_id, n_subclusters))
+
+        # Untouched clusters already respect the constraints
+        to_check = changed
+
+    return state.to_frame(data)
+
+def enforce_radius_incremental(data, max_radius, radius_splitting, distance_method='geodesic'):
+
+    state = ClusterState(data, distance_method)
+    to_check = state.clusters()
+
+    while to_check:
+        changed = []
+        for cluster_id in to_check:
+            radius = state.radius(cluster_id)
+
+            if radius > max_radius and state.points[cluster_id] > 1:
+                print('cluster to split due to radius ', cluster_id, radius)
+                if radius_splitting == 'double':
+                    n_subclusters = 2
+                else:
+                    n_subclusters = int(radius / max_radius) + 1
+                changed.extend(state.split(cluster_id, n_subclusters))
+
+        to_check = changed
+
+    return state.to_frame(data)
+
+def repair_capacity(data1, max_quantity, max_points, repair='full'):
 
-    data1['cluster_label'] = data1['cluster'].apply(lambda x: f'Cluster {x}')
-    
     # Capacity constraints
     data2 = data1.copy()
 
+    if repair == 'incremental':
+        data2 = adjust_capacity_incremental(data2, max_quantity, max_points)
+
     current_max_points, current_max_quantity, cluster_quantity_sum, cluster_sizes, quantity_stats = get_cluster_stats(data2)
 
     print('CLUSTERS TOTAL QUANTITIES')
@@ -197,7 +324,7 @@ def clustering_kmeans(data, initial_clusters, max_radius, max_quantity, max_poin
     print('CLUSTERS TOTAL POINTS')
     print(cluster_sizes)
 
-    while current_max_points > max_points or current_max_quantity > max_quantity:
+    while repair == 'full' and (current_max_points > max_points or current_max_quantity > max_quantity):
         
         data2 = adjust_capacity_constraints(data2, max_quantity, max_points)
         
@@ -210,42 +337,229 @@ def clustering_kmeans(data, initial_clusters, max_radius, max_quantity, max_poin
 
     data2['cluster_label'] = data2['cluster'].apply(lambda x: f'Cluster {x}')
 
+    return data2
+
+def repair_radius(data2, max_radius, radius_splitting, distance_method='geodesic', repair='full'):
+
     # Radius constraints
 
     data3 = data2.copy()
 
-    current_max_radius, clusters_radius = get_cluster_stats_radius(data3)
+    if repair == 'incremental':
+        data3 = enforce_radius_incremental(data3, max_radius, radius_splitting, distance_method)
+
+    current_max_radius, clusters_radius = get_cluster_stats_radius(data3, distance_method)
 
     print('CLUSTERS MAX RADIUS')
     print(clusters_radius)
 
-    while current_max_radius > max_radius:
+    while repair == 'full' and current_max_radius > max_radius:
         
-        data3 = enforce_radius_constraint(data3, max_radius, radius_splitting)
+        data3 = enforce_radius_constraint(data3, max_radius, radius_splitting, distance_method)
         
-        current_max_radius, clusters_radius = get_cluster_stats_radius(data3)
+        current_max_radius, clusters_radius = get_cluster_stats_radius(data3, distance_method)
 
         print('CLUSTERS MAX RADIUS')
         print(clusters_radius)
 
     data3['cluster_label'] = data3['cluster'].apply(lambda x: f'Cluster {x}')
+
+    return data3
+
+def clustering_kmeans(data, initial_clusters, max_radius, max_quantity, max_points, conv, random, radius_splitting, distance_method='geodesic', repair='full', kmeans_mode='batch', chunk_size=1024):
+    
+    # Initial Clustering
+    data1, centers1 = initial_kmeans_clustering(data, initial_clusters, conv, random, kmeans_mode, chunk_size)
+
+    data1['cluster_label'] = data1['cluster'].apply(lambda x: f'Cluster {x}')
+    
+    data2 = repair_capacity(data1, max_quantity, max_points, repair)
+
+    data3 = repair_radius(data2, max_radius, radius_splitting, distance_method, repair)
     
     return data1, data2, data3
 
 
+#CAPACITATED KMEANS: quantity/points/radius enforced inside the assignment step
+
+# Greedy-regret assignment under the three budgets. Points with the fewest good alternatives are
+# placed first; a point that fits in no center opens a new center on itself.
+def _regret_assignment(points, quantities, centers, max_radius, max_quantity, max_points, method):
+
+    n, k = len(points), len(centers)
+    distances = geo_distance_matrix(points, centers, method)
+    distances[distances > max_radius] = np.inf
+
+    candidates = np.argsort(distances, axis=1)
+    sorted_distances = np.take_along_axis(distances, candidates, axis=1)
+    best = sorted_distances[:, 0]
+    second = sorted_distances[:, 1] if k > 1 else np.full(n, np.inf)
+    # One option: regret inf (first), no option: -inf (last, they open centers)
+    with np.errstate(invalid='ignore'):
+        regret = np.where(np.isinf(best), -np.inf, second - best)
+    order = np.lexsort((-quantities, -regret))
+
+    centers = list(map(tuple, centers))
+    load_quantity = [0.0] * k
+    load_points = [0] * k
+    opened = []  # distances of all points to the centers opened in this pass
+    labels = np.empty(n, dtype=np.int64)
+
+    for i in order:
+        label, label_distance = -1, np.inf
+        for j in candidates[i]:
+            if np.isinf(distances[i, j]):
+                break
+            if load_quantity[j] + quantities[i] <= max_quantity and load_points[j] < max_points:
+                label, label_distance = j, distances[i, j]
+                break
+        for offset, opened_distances in enumerate(opened):
+            j = k + offset
+            if (opened_distances[i] < label_distance and opened_distances[i] <= max_radius
+                    and load_quantity[j] + quantities[i] <= max_quantity and load_points[j] < max_points):
+                label, label_distance = j, opened_distances[i]
+        if label < 0:
+            label = k + len(opened)
+            centers.append(tuple(points[i]))
+            opened.append(geo_distances(points, points[i], method))
+            load_quantity.append(0.0)
+            load_points.append(0)
+        labels[i] = label
+        load_quantity[label] += quantities[i]
+        load_points[label] += 1
+
+    return labels, np.array(centers)
+
+def capacitated_kmeans(data, initial_clusters, max_radius, max_quantity, max_points, random='fixed', distance_method='geodesic', max_iter=50, tol=0.01):
+    """
+    Capacitated k-means: alternates a budgeted assignment step and a centroid update until
+    at most tol (fraction) of the points change cluster, so every cluster meets max_quantity,
+    max_points and max_radius (around its cluster_center) without a separate repair phase.
+    A single location whose quantity exceeds max_quantity ends up alone in its cluster.
+
+    Returns the clustered data (cluster, cluster_center, cluster_label) and the centers.
+    """
+    data = data.copy()
+    points = data[['latitude', 'longitude']].to_numpy(dtype=np.float64)
+    quantities = data['quantity'].to_numpy(dtype=np.float64)
+
+    # Start from at least as many centers as the total quantity and points require
+    n_clusters = max(initial_clusters, int(np.ceil(quantities.sum() / max_quantity)), int(np.ceil(len(points) / max_points)))
+    n_clusters = min(n_clusters, len(points))
+    centers = kmeans_model(n_clusters, 'max_iter', random).fit(points).cluster_centers_
+
+    labels = None
+    for iteration in range(max_iter):
+        new_labels, assigned_centers = _regret_assignment(points, quantities, centers, max_radius,
+                                                          max_quantity, max_points, distance_method)
+        # Drop centers left empty, keep the order of the others
+        used, new_labels = np.unique(new_labels, return_inverse=True)
+        assigned_centers = assigned_centers[used]
+
+        moved = len(points) if labels is None or len(labels) != len(new_labels) else int((labels != new_labels).sum())
+        converged = labels is not None and moved <= tol * len(points)
+        print(f'ITERATION {iteration}: {len(used)} clusters, {moved} points moved')
+
+        labels = new_labels
+        if converged:
+            break
+
+        # Centroid update
+        counts = np.bincount(labels)
+        centers = np.column_stack([np.bincount(labels, weights=points[:, 0]) / counts,
+                                   np.bincount(labels, weights=points[:, 1]) / counts])
+
+    # The centers the last assignment was made against, so the radius holds
+    data['cluster'] = labels
+    data['cluster_center'] = [tuple(center) for center in assigned_centers[labels]]
+    data['cluster_label'] = data['cluster'].apply(lambda x: f'Cluster {x}')
+
+    return data, assigned_centers
+
+
 #TSP OR-Tools by Google
-def solve_tsp(distance_matrix, cluster_locations):
+
+# Integer arc costs for OR-Tools, distances multiplied by scale and rounded
+def scale_cost_matrix(distance_matrix, scale=1):
+    return np.rint(np.asarray(distance_matrix, dtype=np.float64) * scale).astype(np.int64)
+
+def register_transit(routing, manager, cost_matrix, transit='matrix'):
+    # 'matrix' hands the whole cost matrix to the solver (no Python call per arc) when OR-Tools supports it
+    cost_rows = cost_matrix.tolist()
+    if transit == 'matrix' and hasattr(routing, 'RegisterTransitMatrix'):
+        return routing.RegisterTransitMatrix(cost_rows)
+    return routing.RegisterTransitCallback(lambda from_index, to_index: cost_rows[manager.IndexToNode(from_index)][manager.IndexToNode(to_index)])
+
+METAHEURISTICS = ['GREEDY_DESCENT', 'GUIDED_LOCAL_SEARCH', 'TABU_SEARCH', 'SIMULATED_ANNEALING']
+
+def routing_search_parameters(first_solution='PATH_CHEAPEST_ARC', metaheuristic=None, time_limit=None, solution_limit=None):
+    """
+    OR-Tools search parameters.
+
+    first_solution: FirstSolutionStrategy name, e.g. 'PATH_CHEAPEST_ARC', 'SAVINGS', 'CHRISTOFIDES'
+    metaheuristic: None (local search down to the first local optimum) or one of METAHEURISTICS
+    time_limit: wall-clock budget in seconds; solution_limit: maximum number of solutions found
+    """
+    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    search_parameters.first_solution_strategy = getattr(routing_enums_pb2.FirstSolutionStrategy, first_solution)
+    if metaheuristic is not None:
+        if metaheuristic not in METAHEURISTICS:
+            raise ValueError(f"Unknown metaheuristic '{metaheuristic}', use one of {METAHEURISTICS}")
+        # Guided local search, tabu and annealing only stop on a limit
+        if metaheuristic != 'GREEDY_DESCENT' and time_limit is None and solution_limit is None:
+            raise ValueError(f"{metaheuristic} needs a time_limit or a solution_limit")
+        search_parameters.local_search_metaheuristic = getattr(routing_enums_pb2.LocalSearchMetaheuristic, metaheuristic)
+    if time_limit is not None:
+        search_parameters.time_limit.FromMilliseconds(int(time_limit * 1000))  # seconds
+    if solution_limit is not None:
+        search_parameters.solution_limit = solution_limit
+    return search_parameters
+
+# Everything besides cluster membership and OD data that a cached route depends on
+def tsp_settings(engine='ortools', time_limit=None, first_solution='PATH_CHEAPEST_ARC', metaheuristic=None,
+                 solution_limit=None, scale=1, transit='matrix', max_numpy_size=None):
+    settings = {'engine': engine, 'time_limit': time_limit, 'first_solution': first_solution,
+                'metaheuristic': metaheuristic, 'solution_limit': solution_limit, 'scale': scale}
+    if engine == 'auto':
+        settings['max_numpy_size'] = max_numpy_size  # decides which engine solves a cluster
+    return settings
+
+def solve_tsp(distance_matrix, cluster_locations, time_limit=None, verbose=True, transit='matrix', scale=1,
+              first_solution='PATH_CHEAPEST_ARC', metaheuristic=None, solution_limit=None, on_solution=None,
+              cache=None, od_version=None):
+    """
+    on_solution: called with the route cost (in distance units) for every solution the search accepts
+    cache: RouteCache, a cluster already solved with the same settings is returned without solving
+    od_version: version of the OD matrix the distances come from (hash of distance_matrix if None)
+    """
     tsp_size = len(distance_matrix)
     if tsp_size <= 1:
         return {'total_distance': 0, 'route': []}
 
+    if cache is not None:
+        settings = tsp_settings('ortools', time_limit, first_solution, metaheuristic, solution_limit, scale)
+        if od_version is None:
+            od_version = fingerprint(np.asarray(distance_matrix, dtype=np.float64))
+        result = cache.get_route(cluster_locations, cluster_locations[0], od_version, settings)
+        if result is None:
+            result = solve_tsp(distance_matrix, cluster_locations, time_limit, False, transit, scale,
+                               first_solution, metaheuristic, solution_limit, on_solution)
+            cache.set_route(cluster_locations, cluster_locations[0], od_version, settings, result)
+        if verbose:
+            print("Route:", result['route'])
+            print("Total Distance:", result['total_distance'])
+        return result
+
+    cost_matrix = scale_cost_matrix(distance_matrix, scale)
+
     manager = pywrapcp.RoutingIndexManager(tsp_size, 1, 0)
     routing = pywrapcp.RoutingModel(manager)
-    transit_callback_index = routing.RegisterTransitCallback(lambda from_index, to_index: distance_matrix[manager.IndexToNode(from_index)][manager.IndexToNode(to_index)])
+    transit_callback_index = register_transit(routing, manager, cost_matrix, transit)
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
     
-    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
+    search_parameters = routing_search_parameters(first_solution, metaheuristic, time_limit, solution_limit)
+    if on_solution is not None:
+        routing.AddAtSolutionCallback(lambda: on_solution(routing.CostVar().Max() / scale))
 
     solution = routing.SolveWithParameters(search_parameters)
     
@@ -262,8 +576,446 @@ def solve_tsp(distance_matrix, cluster_locations):
         route.append(manager.IndexToNode(index))
 
     route_with_ids = [cluster_locations[i] for i in route]
+    if scale != 1:
+        total_distance = total_distance / scale
 
-    print("Route:", route_with_ids)
-    print("Total Distance:", total_distance)
+    if verbose:
+        print("Route:", route_with_ids)
+        print("Total Distance:", total_distance)
     
-    return {'total_distance': total_distance, 'route': route_with_ids}
\ No newline at end of file
+    return {'total_distance': total_distance, 'route': route_with_ids}
+
+
+#TSP NumPy heuristic: nearest neighbour + 2-opt/Or-opt, no solver to set up
+
+# Tour as node array that starts and ends at the depot (node 0)
+def nearest_neighbour_tour(distance_matrix):
+    size = len(distance_matrix)
+    visited = np.zeros(size, dtype=bool)
+    tour = np.empty(size + 1, dtype=np.int64)
+    tour[0] = tour[size] = 0
+    visited[0] = True
+    for step in range(1, size):
+        row = np.where(visited, np.inf, distance_matrix[tour[step - 1]])
+        tour[step] = np.argmin(row)
+        visited[tour[step]] = True
+    return tour
+
+def _two_opt(distance, tour, neighbours):
+    # Reversing tour[i+1..j] replaces arcs (t[i], t[i+1]), (t[j], t[j+1]) with (t[i], t[j]), (t[i+1], t[j+1]).
+    # Exact for asymmetric matrices: the reversed segment is costed through the backward prefix sums.
+    size = len(tour) - 1
+    improved = False
+    i = 0
+    while i < size - 1:
+        forward = np.concatenate([[0.0], np.cumsum(distance[tour[:-1], tour[1:]])])
+        backward = np.concatenate([[0.0], np.cumsum(distance[tour[1:], tour[:-1]])])
+        position = np.empty(size, dtype=np.int64)
+        position[tour[:-1]] = np.arange(size)
+
+        # Candidate j: a neighbour of t[i] placed after it, so (t[i], t[j]) becomes an arc
+        j = position[neighbours[tour[i]]]
+        j = j[(j > i + 1) & (j < size)]
+        if len(j):
+            old = distance[tour[i], tour[i + 1]] + forward[j] - forward[i + 1] + distance[tour[j], tour[j + 1]]
+            new = distance[tour[i], tour[j]] + backward[j] - backward[i + 1] + distance[tour[i + 1], tour[j + 1]]
+            gain = old - new
+            best = np.argmax(gain)
+            if gain[best] > 1e-9:
+                tour[i + 1:j[best] + 1] = tour[i + 1:j[best] + 1][::-1]
+                improved = True
+                continue  # try t[i] again
+        i += 1
+    return improved
+
+def _or_opt(distance, tour, neighbours, max_segment=3):
+    # Move a segment of 1..max_segment nodes (same direction) between t[p] and t[p+1]
+    size = len(tour) - 1
+    improved = False
+    for length in range(1, max_segment + 1):
+        i = 1
+        while i + length <= size:
+            position = np.empty(size, dtype=np.int64)
+            position[tour[:-1]] = np.arange(size)
+            first, last = tour[i], tour[i + length - 1]
+            before, after = tour[i - 1], tour[i + length]
+            removal_gain = distance[before, first] + distance[last, after] - distance[before, after]
+
+            # Insert after a neighbour of the segment's first node, or before a neighbour of its last node
+            p = np.concatenate([position[neighbours[first]], position[neighbours[last]] - 1])
+            p = p[((p < i - 1) | (p > i + length - 1)) & (p >= 0)]
+            if len(p):
+                insertion_cost = distance[tour[p], first] + distance[last, tour[p + 1]] - distance[tour[p], tour[p + 1]]
+                best = np.argmin(insertion_cost)
+                if removal_gain - insertion_cost[best] > 1e-9:
+                    segment = tour[i:i + length].copy()
+                    rest = np.concatenate([tour[:i], tour[i + length:]])
+                    insert_at = p[best] + 1 if p[best] < i else p[best] + 1 - length
+                    tour[:] = np.concatenate([rest[:insert_at], segment, rest[insert_at:]])
+                    improved = True
+                    continue
+            i += 1
+    return improved
+
+def solve_tsp_numpy(distance_matrix, cluster_locations, n_neighbours=10, max_rounds=50, verbose=True):
+    """
+    TSP from the depot (node 0) without OR-Tools: nearest-neighbour tour improved by 2-opt and
+    Or-opt moves restricted to each node's n_neighbours closest nodes, until no move improves.
+    Returns the same {'total_distance', 'route'} as solve_tsp; total_distance is not rounded.
+    """
+    distance = np.asarray(distance_matrix, dtype=np.float64)
+    size = len(distance)
+    if size <= 1:
+        return {'total_distance': 0, 'route': []}
+
+    # Closest nodes of every node, itself excluded
+    order = np.argsort(distance + np.diag(np.full(size, np.inf)), axis=1)
+    neighbours = order[:, :min(n_neighbours, size - 1)]
+
+    tour = nearest_neighbour_tour(distance)
+    for _ in range(max_rounds):
+        two_opt = _two_opt(distance, tour, neighbours)
+        or_opt = _or_opt(distance, tour, neighbours)
+        if not (two_opt or or_opt):
+            break
+
+    total_distance = float(distance[tour[:-1], tour[1:]].sum())
+    route_with_ids = [cluster_locations[i] for i in tour]
+
+    if verbose:
+        print("Route:", route_with_ids)
+        print("Total Distance:", total_distance)
+
+    return {'total_distance': total_distance, 'route': route_with_ids}
+
+# Clusters up to max_numpy_size nodes go to the NumPy heuristic, larger ones to OR-Tools.
+# OR-Tools gets scale=1000 by default, so both engines report (near) exact distances that can be summed
+def solve_tsp_auto(distance_matrix, cluster_locations, max_numpy_size=50, verbose=True, scale=1000, **search):
+    if len(distance_matrix) <= max_numpy_size:
+        return solve_tsp_numpy(distance_matrix, cluster_locations, verbose=verbose)
+    return solve_tsp(distance_matrix, cluster_locations, verbose=verbose, scale=scale, **search)
+
+
+#Batch TSP: one process per cluster
+
+def _solve_tsp_worker(cluster_id, distance_matrix, cluster_locations, time_limit, search, engine, max_numpy_size=50):
+    if engine == 'numpy':
+        return cluster_id, solve_tsp_numpy(distance_matrix, cluster_locations, verbose=False)
+    if engine == 'auto':
+        return cluster_id, solve_tsp_auto(distance_matrix, cluster_locations, max_numpy_size, verbose=False,
+                                          time_limit=time_limit, **search)
+    return cluster_id, solve_tsp(distance_matrix, cluster_locations, time_limit=time_limit, verbose=False, **search)
+
+def cluster_locations_by_id(final_cluster, depot_id=0):
+    # Location ids of every cluster, the depot (if any) first
+    clusters = {}
+    for cluster_id, location_ids in final_cluster.groupby('cluster')['location_id']:
+        locations = location_ids.tolist()
+        clusters[cluster_id] = locations if depot_id is None else [depot_id] + locations
+    return clusters
+
+def solve_tsp_parallel(final_cluster, filtered_matrix, depot_id=0, max_workers=None, time_limit=None, verbose=True, search=None,
+                       engine='ortools', cache=None, max_numpy_size=50):
+    """
+    Solve the TSP of every cluster in parallel, yielding (cluster_id, {'total_distance', 'route'})
+    as soon as each cluster is solved.
+
+    time_limit: seconds allowed to each cluster's solver (no limit if None)
+    search: solve_tsp search options, e.g. {'metaheuristic': 'GUIDED_LOCAL_SEARCH', 'scale': 1000}
+    engine: 'ortools' (solve_tsp), 'numpy' (solve_tsp_numpy) or 'auto' (by cluster size, solve_tsp_auto)
+    cache: RouteCache, clusters whose membership was already solved are yielded first, without a worker
+    max_numpy_size: with engine='auto', largest cluster (depot included) solved by solve_tsp_numpy
+    """
+    search = dict(search or {})
+    max_numpy_size = search.pop('max_numpy_size', max_numpy_size)
+    clusters = cluster_locations_by_id(final_cluster, depot_id)
+    if not isinstance(filtered_matrix, ODMatrix):
+        filtered_matrix = ODMatrix.from_frame(filtered_matrix)
+    if engine == 'auto':
+        search = {'scale': 1000, **search}  # the dispatcher's default scale, recorded in the cache key
+    settings = tsp_settings(engine, time_limit, max_numpy_size=max_numpy_size, **search)
+
+    def report(cluster_id, result):
+        if verbose:
+            print("Cluster:", cluster_id)
+            print("Route:", result['route'])
+            print("Total Distance:", result['total_distance'])
+
+    if cache is not None:
+        pending = {}
+        for cluster_id, cluster_locations in clusters.items():
+            result = cache.get_route(cluster_locations, depot_id, filtered_matrix.version, settings)
+            if result is None:
+                pending[cluster_id] = cluster_locations
+            else:
+                report(cluster_id, result)
+                yield cluster_id, result
+        clusters = pending
+    if not clusters:
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_solve_tsp_worker, cluster_id,
+                                   create_distance_matrix(cluster_locations, filtered_matrix),
+                                   cluster_locations, time_limit, search, engine, max_numpy_size)
+                   for cluster_id, cluster_locations in clusters.items()]
+
+        for future in as_completed(futures):
+            cluster_id, result = future.result()
+            if cache is not None:
+                cache.set_route(clusters[cluster_id], depot_id, filtered_matrix.version, settings, result)
+            report(cluster_id, result)
+            yield cluster_id, result
+
+
+#CVRP: several vehicles per cluster, quantity capacity and optional time windows
+
+def solve_cvrp(distance_matrix, cluster_locations, demands, vehicle_capacity, num_vehicles, time_matrix=None,
+               time_windows=None, service_time=0, time_limit=None, verbose=True, scale=1, demand_scale=100):
+    """
+    Capacitated VRP from the depot (node 0) with num_vehicles vehicles of vehicle_capacity quantity.
+
+    demands: quantity of every node (0 for the depot), scaled by demand_scale and rounded up to integers
+    time_matrix: travel times between the nodes (e.g. from Data/OD_Time_Matrix), needed for time_windows
+    time_windows: (earliest, latest) arrival of every node, in the time_matrix unit
+
+    Returns {'total_distance', 'routes', 'loads', 'feasible'}, one route/load per used vehicle.
+    When the solver finds no solution (e.g. total demand over num_vehicles * vehicle_capacity)
+    feasible is False and total_distance is None.
+    """
+    size = len(distance_matrix)
+    if size <= 1:
+        return {'total_distance': 0, 'routes': [], 'loads': [], 'feasible': True}
+
+    manager = pywrapcp.RoutingIndexManager(size, num_vehicles, 0)
+    routing = pywrapcp.RoutingModel(manager)
+    distance_index = register_transit(routing, manager, scale_cost_matrix(distance_matrix, scale))
+    routing.SetArcCostEvaluatorOfAllVehicles(distance_index)
+
+    # Capacity dimension
+    node_demands = np.ceil(np.asarray(demands, dtype=np.float64) * demand_scale).astype(np.int64).tolist()
+    capacity = int(vehicle_capacity * demand_scale)
+    # Over the fleet's capacity, or a node no vehicle can carry: infeasible without searching
+    # (the solver would keep looking for a first solution until time_limit, forever without one)
+    if sum(node_demands) > capacity * num_vehicles or max(node_demands) > capacity:
+        if verbose:
+            print("No feasible solution")
+        return {'total_distance': None, 'routes': [], 'loads': [], 'feasible': False}
+    demand_index = routing.RegisterUnaryTransitVector(node_demands)
+    routing.AddDimensionWithVehicleCapacity(demand_index, 0, [capacity] * num_vehicles,
+                                            True, 'Capacity')
+
+    # Time dimension: travel time + service time at the origin node, waiting allowed
+    if time_windows is not None:
+        travel = scale_cost_matrix(time_matrix)
+        travel[1:, :] += int(service_time)
+        windows = np.rint(np.asarray(time_windows, dtype=np.float64)).astype(np.int64)
+        horizon = int(windows[:, 1].max())
+        time_index = register_transit(routing, manager, travel)
+        routing.AddDimension(time_index, horizon, horizon, False, 'Time')
+        time_dimension = routing.GetDimensionOrDie('Time')
+        for node in range(1, size):
+            time_dimension.CumulVar(manager.NodeToIndex(node)).SetRange(int(windows[node, 0]), int(windows[node, 1]))
+        for vehicle in range(num_vehicles):
+            time_dimension.CumulVar(routing.Start(vehicle)).SetRange(int(windows[0, 0]), int(windows[0, 1]))
+
+    search_parameters = routing_search_parameters(time_limit=time_limit)
+    solution = routing.SolveWithParameters(search_parameters)
+
+    total_distance = 0
+    routes = []
+    loads = []
+    if solution:
+        for vehicle in range(num_vehicles):
+            index = routing.Start(vehicle)
+            if routing.IsEnd(solution.Value(routing.NextVar(index))):
+                continue  # vehicle not used
+            route = []
+            load = 0.0
+            while not routing.IsEnd(index):
+                node = manager.IndexToNode(index)
+                route.append(cluster_locations[node])
+                load += demands[node]
+                previous_index = index
+                index = solution.Value(routing.NextVar(index))
+                total_distance += routing.GetArcCostForVehicle(previous_index, index, vehicle)
+            route.append(cluster_locations[manager.IndexToNode(index)])
+            routes.append(route)
+            loads.append(load)
+
+    if not solution:
+        if verbose:
+            print("No feasible solution")
+        return {'total_distance': None, 'routes': [], 'loads': [], 'feasible': False}
+
+    if scale != 1:
+        total_distance = total_distance / scale
+
+    if verbose:
+        for route, load in zip(routes, loads):
+            print("Route:", route, "Load:", load)
+        print("Total Distance:", total_distance)
+
+    return {'total_distance': total_distance, 'routes': routes, 'loads': loads, 'feasible': True}
+
+def _solve_cvrp_worker(cluster_id, distance_matrix, cluster_locations, demands, vehicle_capacity, num_vehicles,
+                       time_matrix, time_windows, service_time, time_limit):
+    return cluster_id, solve_cvrp(distance_matrix, cluster_locations, demands, vehicle_capacity, num_vehicles,
+                                  time_matrix, time_windows, service_time, time_limit, verbose=False)
+
+def solve_cvrp_parallel(final_cluster, filtered_matrix, vehicle_capacity, num_vehicles=None, time_matrix=None,
+                        time_windows=None, service_time=0, depot_id=0, max_workers=None, time_limit=None, verbose=True):
+    """
+    Solve every cluster as a CVRP in parallel, yielding (cluster_id, {'total_distance', 'routes', 'loads', 'feasible'})
+    as soon as each cluster is solved; infeasible clusters are yielded too, with feasible False.
+
+    num_vehicles: vehicles per cluster, if None one more than the cluster's quantity strictly needs
+    time_matrix: OD time matrix (ODMatrix or frame, e.g. from Data/OD_Time_Matrix)
+    time_windows: {location_id: (earliest, latest)}, the depot included; locations missing are unconstrained
+    """
+    clusters = cluster_locations_by_id(final_cluster, depot_id)
+    quantities = final_cluster.set_index('location_id')['quantity']
+    if not isinstance(filtered_matrix, ODMatrix):
+        filtered_matrix = ODMatrix.from_frame(filtered_matrix)
+    if time_matrix is not None and not isinstance(time_matrix, ODMatrix):
+        time_matrix = ODMatrix.from_frame(time_matrix)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for cluster_id, cluster_locations in clusters.items():
+            demands = quantities.reindex(cluster_locations).fillna(0).to_numpy()
+            vehicles = num_vehicles or int(np.ceil(demands.sum() / vehicle_capacity)) + 1
+            cluster_times = None
+            cluster_windows = None
+            if time_windows is not None:
+                cluster_times = create_distance_matrix(cluster_locations, time_matrix)
+                horizon = max(end for _, end in time_windows.values())
+                cluster_windows = [time_windows.get(location_id, (0, horizon)) for location_id in cluster_locations]
+            futures.append(executor.submit(_solve_cvrp_worker, cluster_id,
+                                           create_distance_matrix(cluster_locations, filtered_matrix),
+                                           cluster_locations, demands, vehicle_capacity, vehicles,
+                                           cluster_times, cluster_windows, service_time, time_limit))
+
+        for future in as_completed(futures):
+            cluster_id, result = future.result()
+            if verbose:
+                print("Cluster:", cluster_id)
+                if not result['feasible']:
+                    print("No feasible solution")
+                for route, load in zip(result['routes'], result['loads']):
+                    print("Route:", route, "Load:", load)
+                print("Total Distance:", result['total_distance'])
+            yield cluster_id, result
+
+
+#LINE-HAUL: depot -> hubs routing over haversine_matrix_hubs
+
+# Hub matrix with the depot prepended as node 0, labelled 'depot'; hubs follow in cluster_df order
+def linehaul_problem(hub_matrix, cluster_df, depot):
+    hub_distances = geo_distances(cluster_df[['latitude', 'longitude']].to_numpy(), depot, 'haversine')
+    matrix = np.zeros((len(cluster_df) + 1, len(cluster_df) + 1))
+    matrix[1:, 1:] = hub_matrix
+    matrix[0, 1:] = matrix[1:, 0] = hub_distances
+    return matrix, ['depot'] + cluster_df['hub_id'].tolist()
+
+def _linehaul_key(matrix, cluster_df, num_trucks, truck_capacity, time_limit, scale):
+    # RouteCache version and settings of a line-haul, the same ones solve_tsp uses for a single truck
+    if num_trucks == 1:
+        return fingerprint(np.asarray(matrix, dtype=np.float64)), tsp_settings('ortools', time_limit, scale=scale)
+    # Hub demands are part of the problem, they go in the version next to the distances
+    demands = np.concatenate([[0.0], cluster_df['quantity'].to_numpy()])
+    settings = {'engine': 'cvrp', 'num_trucks': num_trucks, 'truck_capacity': truck_capacity,
+                'time_limit': time_limit, 'scale': scale}
+    return fingerprint(matrix, demands), settings
+
+def solve_linehaul(hub_matrix, cluster_df, depot, num_trucks=1, truck_capacity=None, time_limit=None, verbose=True,
+                   cache=None, scale=1000):
+    """
+    Route from the depot (latitude, longitude) through all the hubs of haversine_matrix_hubs.
+
+    One truck: solve_tsp's {'total_distance', 'route'}.
+    Several trucks: solve_cvrp's {'total_distance', 'routes', 'loads', 'feasible'}, every hub's quantity
+    as its demand and truck_capacity (required) per truck.
+    Either result is served from the RouteCache when given.
+    """
+    if num_trucks > 1 and truck_capacity is None:
+        raise ValueError("truck_capacity is required with more than one truck")
+
+    matrix, locations = linehaul_problem(hub_matrix, cluster_df, depot)
+    if num_trucks == 1:
+        return solve_tsp(matrix, locations, time_limit=time_limit, verbose=verbose, scale=scale, cache=cache)
+
+    demands = np.concatenate([[0.0], cluster_df['quantity'].to_numpy()])
+    if cache is not None:
+        od_version, settings = _linehaul_key(matrix, cluster_df, num_trucks, truck_capacity, time_limit, scale)
+        result = cache.get_route(locations, 'depot', od_version, settings)
+        if result is not None:
+            if verbose:
+                for route, load in zip(result['routes'], result['loads']):
+                    print("Route:", route, "Load:", load)
+                print("Total Distance:", result['total_distance'])
+            return result
+
+    result = solve_cvrp(matrix, locations, demands, truck_capacity, num_trucks, time_limit=time_limit,
+                        verbose=verbose, scale=scale)
+    if cache is not None:
+        cache.set_route(locations, 'depot', od_version, settings, result)
+    return result
+
+def _solve_linehaul_worker(hubs, hub_matrix, cluster_df, depot, num_trucks, truck_capacity, time_limit, scale):
+    return hubs, solve_linehaul(hub_matrix, cluster_df, depot, num_trucks, truck_capacity, time_limit, False,
+                                scale=scale)
+
+def linehaul_sweep(data, hub_counts, depot, num_trucks=1, truck_capacity=None, max_workers=None, time_limit=None,
+                   cache=None, verbose=True, scale=1000):
+    """
+    Fit the hubs for every count in hub_counts, each fit seeded from the previous count's centers
+    (the first one runs the full 10-init KMeans), then route every hub set in parallel.
+    Yields (hubs, cluster_df, result) as soon as each line-haul is solved.
+    cache: RouteCache, hub sets already solved are yielded first, without a worker
+    """
+    if num_trucks > 1 and truck_capacity is None:
+        raise ValueError("truck_capacity is required with more than one truck")
+
+    hub_sets = {}
+    previous_centers = None
+    index = SpatialIndex(data)
+    for hubs in hub_counts:
+        hub_matrix, cluster_df = haversine_matrix_hubs(data.copy(), hubs, previous_centers, index)
+        hub_sets[hubs] = (hub_matrix, cluster_df)
+        previous_centers = cluster_df[['latitude', 'longitude']].to_numpy()
+
+    def report(hubs, result):
+        if verbose:
+            print("Hubs:", hubs)
+            print("Total Distance:", result['total_distance'])
+
+    keys = {}
+    if cache is not None:
+        pending = {}
+        for hubs, (hub_matrix, cluster_df) in hub_sets.items():
+            matrix, locations = linehaul_problem(hub_matrix, cluster_df, depot)
+            od_version, settings = _linehaul_key(matrix, cluster_df, num_trucks, truck_capacity, time_limit, scale)
+            result = cache.get_route(locations, 'depot', od_version, settings)
+            if result is None:
+                pending[hubs] = (hub_matrix, cluster_df)
+                keys[hubs] = (locations, od_version, settings)
+            else:
+                report(hubs, result)
+                yield hubs, cluster_df, result
+        hub_sets = pending
+    if not hub_sets:
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_solve_linehaul_worker, hubs, hub_matrix, cluster_df, depot, num_trucks,
+                                   truck_capacity, time_limit, scale)
+                   for hubs, (hub_matrix, cluster_df) in hub_sets.items()]
+
+        for future in as_completed(futures):
+            hubs, result = future.result()
+            if cache is not None:
+                locations, od_version, settings = keys[hubs]
+                cache.set_route(locations, 'depot', od_version, settings, result)
+            report(hubs, result)
+            yield hubs, hub_sets[hubs][1], result
@@ -0,0 +1,98 @@
+import numpy as np
+from cache_func import DiskLRUCache, fingerprint
+from models2 import initial_kmeans_clustering, repair_capacity, repair_radius, solve_tsp_parallel
+from support_func2 import calculate_sse, ODMatrix
+
+STAGES = ['kmeans', 'capacity', 'radius', 'sse', 'routes']
+
+# Compact checkpoint of a clustering stage: cluster per location_id + one center per cluster
+def _assignment(data):
+    clusters = data['cluster'].to_numpy(dtype=np.int64)
+    cluster_ids, first = np.unique(clusters, return_index=True)
+    centers = np.array(data['cluster_center'].iloc[first].tolist(), dtype=np.float64)
+    return {'location_id': data['location_id'].to_numpy(), 'cluster': clusters,
+            'cluster_ids': cluster_ids, 'centers': centers}
+
+def _restore(data, assignment):
+    # Rows in the checkpointed order (the full repair regroups them by cluster)
+    positions = data.reset_index(drop=True).reset_index().set_index('location_id')['index']
+    restored = data.iloc[positions.loc[assignment['location_id']].to_numpy()].copy()
+    restored['cluster'] = assignment['cluster']
+    centers = dict(zip(assignment['cluster_ids'].tolist(), map(tuple, assignment['centers'].tolist())))
+    restored['cluster_center'] = restored['cluster'].map(centers)
+    restored['cluster_label'] = restored['cluster'].apply(lambda x: f'Cluster {x}')
+    return restored
+
+class ClusterRoutePipeline:
+    """
+    Exercise 2 flow (initial KMeans -> capacity repair -> radius repair -> SSE -> TSP routes)
+    with every stage checkpointed on disk.
+
+    A stage's key hashes its upstream key and its own parameters, so a rerun that only
+    changes e.g. max_radius loads the KMeans and capacity stages from their checkpoints.
+    """
+
+    def __init__(self, checkpoint_dir='./Data/pipeline_checkpoints', route_cache=None):
+        # Checkpoints are kept until deleted, never evicted
+        self.checkpoints = DiskLRUCache(checkpoint_dir, max_bytes=None)
+        # RouteCache shared across runs: a recomputed routes stage only solves clusters whose membership changed
+        self.route_cache = route_cache
+        self.log = {}
+
+    def _stage(self, name, key, compute):
+        value = self.checkpoints.get(key)
+        if value is None:
+            value = compute()
+            self.checkpoints.set(key, value)
+            self.log[name] = 'computed'
+        else:
+            self.log[name] = 'checkpoint'
+        return value
+
+    def run(self, data, od_matrix, initial_clusters, max_radius, max_quantity, max_points, conv, random,
+            radius_splitting, distance_method='geodesic', repair='full', depot_id=0, max_workers=None,
+            time_limit=None, kmeans_mode='batch', chunk_size=1024, od_version=None):
+        """
+        Returns {'initial', 'capacity', 'final', 'sse', 'routes'}; routes maps cluster_id to
+        solve_tsp's {'total_distance', 'route'}. self.log records which stages were recomputed.
+
+        od_matrix: ODMatrix or OD frame (rows location_id, columns str(location_id))
+        od_version: version of the OD data for the routes key; if None it is ODMatrix.version, which
+                    hashes the whole matrix on every run; pass it to skip the hash
+        """
+        self.log = {}
+        if not isinstance(od_matrix, ODMatrix):
+            od_matrix = ODMatrix.from_frame(od_matrix, od_version)
+        elif od_version is not None:
+            od_matrix = ODMatrix(od_matrix.matrix, od_matrix.rows, od_matrix.cols, od_version)
+
+        data_key = fingerprint('data', data['location_id'].to_numpy(), data['quantity'].to_numpy(),
+                               data[['latitude', 'longitude']].to_numpy())
+        kmeans_key = fingerprint(data_key, 'kmeans', initial_clusters, conv, random, kmeans_mode, chunk_size)
+        capacity_key = fingerprint(kmeans_key, 'capacity', max_quantity, max_points, repair)
+        radius_key = fingerprint(capacity_key, 'radius', max_radius, radius_splitting, distance_method, repair)
+        sse_key = fingerprint(radius_key, 'sse', distance_method)
+        routes_key = fingerprint(radius_key, 'routes', od_matrix.version, depot_id, time_limit)
+
+        def kmeans():
+            data1, _ = initial_kmeans_clustering(data.copy(), initial_clusters, conv, random,
+                                                 kmeans_mode, chunk_size)
+            return _assignment(data1)
+        data1 = _restore(data, self._stage('kmeans', kmeans_key, kmeans))
+
+        def capacity():
+            return _assignment(repair_capacity(data1, max_quantity, max_points, repair))
+        data2 = _restore(data, self._stage('capacity', capacity_key, capacity))
+
+        def radius():
+            return _assignment(repair_radius(data2, max_radius, radius_splitting, distance_method, repair))
+        data3 = _restore(data, self._stage('radius', radius_key, radius))
+
+        sse = self._stage('sse', sse_key, lambda: calculate_sse(data3, distance_method))
+
+        def routes():
+            return dict(solve_tsp_parallel(data3, od_matrix, depot_id, max_workers, time_limit, verbose=False,
+                                           cache=self.route_cache))
+        routes = self._stage('routes', routes_key, routes)
+
+        return {'initial': data1, 'capacity': data2, 'final': data3, 'sse': sse, 'routes': routes}
@@ -2,7 +2,7 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import seaborn as sns
 import matplotlib.pyplot as plt
-from support_func import pivot_weekday
+from support_func import pivot_weekday, select_location
 import warnings
 import numpy as np
 import pandas as pd
@@ -117,7 +117,7 @@ def quantity_trends(locations_selected, df, weekly_data, daily_data, df_withoutG
     
 
     for i, location_id in enumerate(locations_selected):
-        location_data = df[df['location_id'].astype(str) == location_id]
+        location_data = select_location(df, location_id)
     
         # 1. Period data bar plot
         event_data = location_data[location_data['is_event'] == 1]
@@ -132,7 +132,7 @@ def quantity_trends(locations_selected, df, weekly_data, daily_data, df_withoutG
             axes[i*num_cols].set_xticklabels(event_data['delivery_date'], rotation=45, ha='right')
     
         # 2. Weekly data bar plot
-        weekly_loc_data = weekly_data[weekly_data['location_id'].astype(str) == location_id]
+        weekly_loc_data = select_location(weekly_data, location_id)
         non_zero_weeks = weekly_loc_data[weekly_loc_data['quantity1'] > 0]
         axes[i*num_cols + 1].bar(non_zero_weeks['week_number'], non_zero_weeks['quantity1'], color=pastel_colors[1])
         axes[i*num_cols + 1].set_xlabel('Week Number')
@@ -187,7 +187,7 @@ def quantity_forecast(location_id, weekly_data, daily_data, df_withoutGEO, forec
 
     # 1. Weekly data bar plot (Historical and Forecast)
     # Filter weekly data for the specified location_id
-    weekly_loc_data = weekly_data[weekly_data['location_id'].astype(str) == location_id]
+    weekly_loc_data = select_location(weekly_data, location_id)
     non_zero_weeks = weekly_loc_data[weekly_loc_data['quantity1'] > 0]
     
     # Plot historical data in bar plot
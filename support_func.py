@@ -1,4 +1,8 @@
 
+import os
+import shutil
+import warnings
+import numpy as np
 import pandas as pd
 
 # IQR Method
@@ -10,9 +14,35 @@ def trim_outliers(series):
     upper_bound = Q3 + 1.5 * IQR
     return series.clip(lower=lower_bound, upper=upper_bound)
 
+#Location lookup: rows grouped by location_id once, then any POS is a dict lookup + slice
+class LocationIndex:
+
+    def __init__(self, df):
+        location_ids = df['location_id'].to_numpy()
+        order = np.argsort(location_ids, kind='stable')
+        self.frame = df.iloc[order]
+        unique_ids, starts = np.unique(location_ids[order], return_index=True)
+        stops = np.append(starts[1:], len(order))
+        self.offsets = {int(location_id): (start, stop) for location_id, start, stop in zip(unique_ids, starts, stops)}
+
+    def __contains__(self, location_id):
+        return int(location_id) in self.offsets
+
+    def get(self, location_id):
+        start, stop = self.offsets.get(int(location_id), (0, 0))
+        return self.frame.iloc[start:stop]
+
+# Rows of one location_id (exact match), from a LocationIndex or a plain frame
+def select_location(data, location_id):
+    if isinstance(data, LocationIndex):
+        return data.get(location_id)
+    if pd.api.types.is_integer_dtype(data['location_id']):
+        return data[data['location_id'] == int(location_id)]
+    return data[data['location_id'].astype(str) == str(location_id)]
+
 #Pivot for week number / weekday
 def pivot_weekday(df_withoutGEO,location_id_filter):
-    df_filtered = df_withoutGEO[df_withoutGEO['location_id'].astype(str).str.contains(location_id_filter)]
+    df_filtered = select_location(df_withoutGEO, location_id_filter)
 
     df_pivot = df_filtered.pivot_table(
         index='week_number', 
@@ -30,7 +60,7 @@ def combined_weekly_stats(locations_selected, weekly_stats):
     location_dfs = []
     
     for location_id in locations_selected:
-        location_data = weekly_stats[weekly_stats['location_id'].astype(str) == str(location_id)][['weekday', 'mean', 'var']]
+        location_data = select_location(weekly_stats, location_id)[['weekday', 'mean', 'var']]
         
         location_data = location_data.set_index('weekday')
         location_data.columns = [f"Location_{location_id}_mean", f"Location_{location_id}_var"]
@@ -43,4 +73,345 @@ def combined_weekly_stats(locations_selected, weekly_stats):
     combined_df.sort_values(by="weekday", key=lambda column: column.map(lambda e: weekday_order.index(e)), inplace=True)
     combined_df = combined_df.fillna('-')
 
-    return combined_df
\ No newline at end of file
+    return combined_df
+
+
+#INGESTION: forecast_data.csv read in chunks with compact dtypes, cached as Parquet
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+FORECAST_DTYPES = {
+    'location_id': 'int32',
+    'quantity1': 'float32',
+    'is_event': 'int8',
+    'latitude': 'float32',
+    'longitude': 'float32',
+}
+
+def _add_calendar_columns(chunk):
+    iso = chunk['delivery_date'].dt.isocalendar()
+    chunk['iso_year'] = iso['year'].astype('int16')
+    chunk['week_number'] = iso['week'].astype('int16')
+    chunk['weekday'] = chunk['delivery_date'].dt.weekday.astype('int8')  # 0 = Monday, see WEEKDAYS
+    return chunk
+
+def ingest_forecast_data(csv_path='./Data/forecast_data.csv', cache_dir='./Data/forecast_cache', chunksize=500_000, n_buckets=64):
+    """
+    Stream forecast_data.csv in chunks, aggregating weekly and weekday totals on the fly.
+
+    Writes to cache_dir:
+      daily/    the typed rows, partitioned by location bucket (location_id % n_buckets)
+      weekly.parquet, weekday.parquet    totals of quantity1 and is_event per location
+    """
+    daily_dir = os.path.join(cache_dir, 'daily')
+    if os.path.isdir(daily_dir):
+        shutil.rmtree(daily_dir)  # rebuilt from scratch, the dataset is append-only
+    os.makedirs(daily_dir)
+
+    weekly_parts, weekday_parts = [], []
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype=FORECAST_DTYPES, parse_dates=['delivery_date']):
+        chunk = _add_calendar_columns(chunk)
+
+        # Partial totals of this chunk, summed again at the end
+        weekly_parts.append(chunk.groupby(['location_id', 'iso_year', 'week_number'], observed=True)[['quantity1', 'is_event']].sum())
+        weekday_parts.append(chunk.groupby(['location_id', 'weekday'], observed=True)[['quantity1', 'is_event']].sum())
+
+        chunk['location_bucket'] = (chunk['location_id'] % n_buckets).astype('int16')
+        chunk.to_parquet(daily_dir, partition_cols=['location_bucket'], index=False)
+
+    weekly_data = pd.concat(weekly_parts).groupby(level=[0, 1, 2]).sum().reset_index()
+    weekday_data = pd.concat(weekday_parts).groupby(level=[0, 1]).sum().reset_index()
+    weekly_data.to_parquet(os.path.join(cache_dir, 'weekly.parquet'), index=False)
+    weekday_data.to_parquet(os.path.join(cache_dir, 'weekday.parquet'), index=False)
+
+    return cache_dir
+
+def load_forecast_cache(cache_dir='./Data/forecast_cache', location_ids=None, n_buckets=64):
+    # Typed daily rows (only the buckets of location_ids if given), weekly and weekday totals
+    filters = None
+    if location_ids is not None:
+        location_ids = [int(location_id) for location_id in location_ids]
+        buckets = sorted({location_id % n_buckets for location_id in location_ids})
+        filters = [('location_bucket', 'in', buckets), ('location_id', 'in', location_ids)]
+
+    daily = pd.read_parquet(os.path.join(cache_dir, 'daily'), filters=filters).drop(columns='location_bucket')
+    weekly_data = pd.read_parquet(os.path.join(cache_dir, 'weekly.parquet'))
+    weekday_data = pd.read_parquet(os.path.join(cache_dir, 'weekday.parquet'))
+    if location_ids is not None:
+        weekly_data = weekly_data[weekly_data['location_id'].isin(location_ids)]
+        weekday_data = weekday_data[weekday_data['location_id'].isin(location_ids)]
+
+    for frame in (daily, weekly_data, weekday_data):
+        frame['location_id'] = frame['location_id'].astype('category')
+    daily = daily.sort_values(['location_id', 'delivery_date']).reset_index(drop=True)
+
+    return daily, weekly_data.reset_index(drop=True), weekday_data.reset_index(drop=True)
+
+#AGGREGATE CUBE: one pass over the daily rows, every per-location view is served from it
+
+CUBE_KEYS = ['location_id', 'week_number', 'weekday', 'is_event']
+
+# Columns that order the weeks: (iso_year, week_number) when iso_year is there, so years don't mix
+def week_keys(df):
+    return ['iso_year', 'week_number'] if 'iso_year' in df.columns else ['week_number']
+
+class AggregateCube:
+    """
+    Sum, count and sum of squares of quantity1 indexed by (location_id, week_number, weekday, is_event),
+    with iso_year before week_number when the rows have it (load_forecast_cache output).
+
+    Built in a single groupby over the daily rows (notebook df or load_forecast_cache output),
+    new delivery days can be added with append().
+    """
+
+    def __init__(self, df):
+        self.week_keys = week_keys(df)
+        self.keys = CUBE_KEYS[:1] + self.week_keys + CUBE_KEYS[2:]
+        self.cube = self._aggregate(df)
+        self.locations = self._locations(df)
+
+    def _aggregate(self, df):
+        rows = df[self.keys + ['quantity1']].copy()
+        if not pd.api.types.is_integer_dtype(rows['weekday']):
+            rows['weekday'] = rows['weekday'].astype(str).map(WEEKDAYS.index)  # day_name() strings
+        rows['location_id'] = rows['location_id'].astype('int64')
+        rows['weekday'] = rows['weekday'].astype('int8')
+        rows['quantity1_sq'] = rows['quantity1'].astype('float64') ** 2
+
+        cube = rows.groupby(self.keys).agg(
+            sum=('quantity1', 'sum'),
+            count=('quantity1', 'size'),
+            sum_sq=('quantity1_sq', 'sum'))
+        return cube.sort_index()
+
+    @staticmethod
+    def _locations(df):
+        if 'latitude' not in df.columns:
+            return pd.DataFrame(columns=['latitude', 'longitude'])
+        locations = df.groupby('location_id', observed=True)[['latitude', 'longitude']].first()
+        locations.index = locations.index.astype('int64')
+        return locations
+
+    def append(self, new_df):
+        # Add new delivery days: only the new rows are aggregated, then summed cell by cell
+        self.cube = self.cube.add(self._aggregate(new_df), fill_value=0).astype({'count': 'int64'}).sort_index()
+        self.locations = self.locations.combine_first(self._locations(new_df))
+
+    def location(self, location_id):
+        # Cube cells of one location, a slice of the sorted index
+        return self.cube.xs(int(location_id), level='location_id', drop_level=False)
+
+    def _totals(self, cube, by):
+        cells = cube.reset_index()
+        cells['events'] = cells['count'] * cells['is_event']
+        totals = cells.groupby(by).agg(
+            quantity1=('sum', 'sum'),
+            is_event=('events', 'sum'),
+            days=('count', 'sum'))
+        return totals.reset_index()
+
+    def weekly_data(self):
+        weekly = self._totals(self.cube, ['location_id'] + self.week_keys)
+        return weekly[['location_id'] + self.week_keys + ['quantity1', 'is_event']]
+
+    def daily_data(self):
+        totals = self._totals(self.cube, ['location_id', 'weekday'])
+        totals['weekday'] = [WEEKDAYS[day] for day in totals['weekday']]
+        totals = totals.sort_values(['location_id', 'weekday']).reset_index(drop=True)
+        return totals[['location_id', 'weekday', 'quantity1', 'is_event']]
+
+    def weekly_stats(self, location_ids=None):
+        # Mean and variance of quantity1 per weekday, on event days only
+        cube = self.cube.xs(1, level='is_event', drop_level=False)
+        if location_ids is not None:
+            cube = cube[cube.index.get_level_values('location_id').isin([int(l) for l in location_ids])]
+        cells = cube.groupby(['location_id', 'weekday'])[['sum', 'count', 'sum_sq']].sum()
+        stats = pd.DataFrame({
+            'mean': cells['sum'] / cells['count'],
+            'var': (cells['sum_sq'] - cells['sum'] ** 2 / cells['count']) / (cells['count'] - 1),
+        }).reset_index()
+        stats.loc[stats['var'] < 0, 'var'] = 0.0  # rounding on constant series
+        stats['weekday'] = [WEEKDAYS[day] for day in stats['weekday']]
+        return stats.sort_values(['location_id', 'weekday']).reset_index(drop=True)
+
+    def location_summary(self):
+        # days_recorded, events_count, total_quantity and event percentages per location
+        totals = self._totals(self.cube, ['location_id']).set_index('location_id')
+        summary = pd.DataFrame({
+            'total_quantity': totals['quantity1'],
+            'days_recorded': totals['days'],
+            'events_count': totals['is_event'],
+        })
+        summary['event_percentage'] = summary['events_count'] / summary['days_recorded'] * 100
+        summary['zero_event_percentage'] = (1 - summary['event_percentage'] / 100) * 100
+        summary['events_per_day'] = summary['events_count'] / summary['days_recorded']
+        return summary
+
+    def df_GEO(self):
+        summary = self.location_summary()
+        df_GEO = pd.DataFrame({
+            'days_recorded': summary['days_recorded'],
+            'events_count': summary['events_count'],
+            'quantity': summary['total_quantity'],
+        }).join(self.locations)
+        df_GEO.index.name = 'location_id'
+        return df_GEO.reset_index()
+
+    def pivot_weekday(self, location_id):
+        # Week number x weekday totals of one location
+        cells = self.location(location_id).groupby(self.week_keys + ['weekday'])['sum'].sum()
+        pivot = cells.unstack('weekday', fill_value=0)
+        pivot.columns = [WEEKDAYS[day] for day in pivot.columns]
+        pivot = pivot[sorted(pivot.columns)]  # same column order as pivot_table on weekday names
+        pivot.columns.name = 'weekday'
+        if 'iso_year' in self.week_keys:
+            # One 'YYYY-Www' week_number label per row, so set_index('week_number') stays unique across years
+            years = pivot.index.get_level_values('iso_year')
+            weeks = pivot.index.get_level_values('week_number')
+            pivot.index = [f'{year}-W{week:02d}' for year, week in zip(years, weeks)]
+            pivot.index.name = 'week_number'
+        return pivot.reset_index()
+
+    def combined_weekly_stats(self, locations_selected):
+        return combined_weekly_stats(locations_selected, self.weekly_stats(locations_selected))
+
+#OUTLIER CLEANING: every location's weekly series in one grouped pass
+
+def _group_positions(group_codes):
+    # Position of each row inside its (contiguous) group and the group sizes
+    sizes = np.bincount(group_codes)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    return np.arange(len(group_codes)) - starts[group_codes], sizes
+
+def grouped_decompose(values, group_codes, period=4):
+    """
+    Additive decomposition (same as statsmodels seasonal_decompose) of many series stored one after
+    the other in a flat array, group_codes giving the series of each value (contiguous, ordered by time).
+    Returns trend, seasonal and residual flat arrays, NaN where the moving average is undefined.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    positions, sizes = _group_positions(group_codes)
+
+    # Centred moving average (2 x period for an even period) over the flat array,
+    # dropped where the window crosses the start or the end of a series
+    if period % 2 == 0:
+        weights = np.r_[0.5, np.ones(period - 1), 0.5] / period
+    else:
+        weights = np.ones(period) / period
+    half = len(weights) // 2
+    trend = np.full(len(values), np.nan)
+    if len(values) >= len(weights):
+        trend[half:len(values) - half] = np.convolve(values, weights, mode='valid')
+    trend[(positions < half) | (positions >= sizes[group_codes] - half)] = np.nan
+
+    # Seasonal component: mean detrended value per phase, centred per series
+    detrended = values - trend
+    phase = positions % period
+    phase_means = pd.Series(detrended).groupby([group_codes, phase]).mean().unstack()
+    phase_means = phase_means.sub(phase_means.mean(axis=1), axis=0)
+    seasonal = phase_means.to_numpy()[group_codes, phase]
+
+    return trend, seasonal, detrended - seasonal
+
+def batch_seasonal_decompose(series, period=4):
+    """
+    Additive decomposition of many series at once, same result as statsmodels seasonal_decompose.
+
+    series: 2D array (one series per row), or a list of 1D arrays.
+    Equal-length series are stacked and decomposed with one vectorized moving average;
+    ragged lists fall back to grouped_decompose over the concatenated values.
+    Returns trend, seasonal, residual with the same layout as the input.
+    """
+    if not isinstance(series, np.ndarray):
+        lengths = {len(s) for s in series}
+        if len(lengths) > 1:
+            sizes = [len(s) for s in series]
+            group_codes = np.repeat(np.arange(len(series)), sizes)
+            components = grouped_decompose(np.concatenate(series), group_codes, period)
+            splits = np.cumsum(sizes)[:-1]
+            return tuple(np.split(component, splits) for component in components)
+        stacked = np.vstack(series).astype(np.float64) if len(series) else np.empty((0, 0))
+        return tuple(list(component) for component in batch_seasonal_decompose(stacked, period))
+
+    values = np.asarray(series, dtype=np.float64)
+    if period % 2 == 0:
+        weights = np.r_[0.5, np.ones(period - 1), 0.5] / period
+    else:
+        weights = np.ones(period) / period
+    half = len(weights) // 2
+
+    # Centred moving average of every row: sliding windows times the filter weights
+    trend = np.full(values.shape, np.nan)
+    if values.shape[1] >= len(weights):
+        trend[:, half:values.shape[1] - half] = np.lib.stride_tricks.sliding_window_view(values, len(weights), axis=1) @ weights
+
+    # Seasonal component: mean detrended value per phase, centred per row
+    detrended = values - trend
+    phase_means = np.full((len(values), period), np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # phases without any trend value
+        for phase in range(min(period, values.shape[1])):
+            phase_means[:, phase] = np.nanmean(detrended[:, phase::period], axis=1)
+        phase_means -= np.nanmean(phase_means, axis=1, keepdims=True)
+    seasonal = phase_means[:, np.arange(values.shape[1]) % period]
+
+    return trend, seasonal, detrended - seasonal
+
+def _grouped_interpolate(values, group_codes):
+    # Linear interpolation of the NaN inside each series (as Series.interpolate(): leading NaN kept, trailing NaN = last value)
+    valid = ~np.isnan(values)
+    index = pd.Series(np.where(valid, np.arange(len(values)), np.nan))
+    previous = index.groupby(group_codes).ffill().to_numpy()
+    following = index.groupby(group_codes).bfill().to_numpy()
+
+    filled = values.copy()
+    missing = ~valid & ~np.isnan(previous)
+    prev_i = previous[missing].astype(int)
+    next_i = np.where(np.isnan(following[missing]), prev_i, following[missing]).astype(int)
+    span = np.maximum(next_i - prev_i, 1)
+    weight = (np.flatnonzero(missing) - prev_i) / span
+    filled[missing] = values[prev_i] + (values[next_i] - values[prev_i]) * np.where(next_i == prev_i, 0, weight)
+    return filled
+
+def clean_outliers(weekly_data, method='residual', k=None, threshold=1.0, period=4, value_col='quantity1'):
+    """
+    Clean the weekly series of every location at once.
+
+    method:
+      'iqr_clip'  clip to [Q1 - k*IQR, Q3 + k*IQR] (trim_outliers, k=1.5)
+      'iqr_mean'  values <= max(Q1 - k*IQR, 0) or >= Q3 + k*IQR replaced by the integer mean (k=1)
+      'residual'  |seasonal decompose residual| > threshold * residual std, then linear interpolation
+    Returns the cleaned frame (cleaned_<value_col> added) and the outlier mask table.
+    """
+    data = weekly_data.sort_values(['location_id'] + week_keys(weekly_data)).reset_index(drop=True)
+    values = data[value_col].to_numpy(dtype=np.float64)
+    group_codes = pd.factorize(data['location_id'], sort=True)[0]
+    groups = pd.Series(values).groupby(group_codes)
+
+    if method in ('iqr_clip', 'iqr_mean'):
+        k = (1.5 if method == 'iqr_clip' else 1.0) if k is None else k
+        q1 = groups.quantile(0.25).to_numpy()[group_codes]
+        q3 = groups.quantile(0.75).to_numpy()[group_codes]
+        lower, upper = q1 - k * (q3 - q1), q3 + k * (q3 - q1)
+        if method == 'iqr_clip':
+            outliers = (values < lower) | (values > upper)
+            cleaned = np.clip(values, lower, upper)
+        else:
+            lower = np.maximum(lower, 0)
+            outliers = (values <= lower) | (values >= upper)
+            means = np.trunc(groups.mean().to_numpy())[group_codes]
+            cleaned = np.where(outliers, means, values)
+    elif method == 'residual':
+        sizes = np.bincount(group_codes)
+        _, _, residuals = batch_seasonal_decompose(np.split(values, np.cumsum(sizes)[:-1]), period)
+        residuals = np.concatenate(residuals)
+        residual_std = pd.Series(residuals).groupby(group_codes).std().to_numpy()[group_codes]
+        outliers = np.abs(residuals) > threshold * residual_std
+        cleaned = _grouped_interpolate(np.where(outliers, np.nan, values), group_codes)
+    else:
+        raise ValueError("method must be 'iqr_clip', 'iqr_mean' or 'residual'")
+
+    data[f'cleaned_{value_col}'] = cleaned
+    outlier_mask = data[['location_id'] + week_keys(data)].copy()
+    outlier_mask['is_outlier'] = outliers
+    return data, outlier_mask
@@ -1,16 +1,126 @@
+import os
 import numpy as np
 import pandas as pd
-from sklearn.cluster import KMeans
+from scipy import sparse
+from sklearn.cluster import KMeans, DBSCAN
+from sklearn.neighbors import BallTree
 from geopy.distance import geodesic
+from cache_func import fingerprint
+
+EARTH_RADIUS = 6378  # Radius of the Earth in km
+
+# WGS-84 ellipsoid (km), the same one geopy's geodesic uses
+WGS84_A = 6378.137
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+
+DISTANCE_METHODS = ('geodesic', 'haversine', 'geopy')
+
+#BATCHED DISTANCES
+
+def _haversine(lat1, lon1, lat2, lon2):
+    # All arguments in radians, broadcastable against each other
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def _vincenty(lat1, lon1, lat2, lon2, tol=1e-12, max_iter=200):
+    # Vincenty inverse problem on the WGS-84 ellipsoid, arguments in radians.
+    # Returns the distances and a mask of the pairs that did not converge (nearly antipodal points).
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(lat1, lon1, lat2, lon2)
+    L = lon2 - lon1
+    U1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+    U2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+    sin_U1, cos_U1 = np.sin(U1), np.cos(U1)
+    sin_U2, cos_U2 = np.sin(U2), np.cos(U2)
+
+    lam = L.copy()
+    converged = np.zeros(L.shape, dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cos_U2 * sin_lam) ** 2 + (cos_U1 * sin_U2 - sin_U1 * cos_U2 * cos_lam) ** 2)
+            cos_sigma = sin_U1 * sin_U2 + cos_U1 * cos_U2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_U1 * cos_U2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            # Equatorial lines have cos2_alpha == 0
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_U1 * sin_U2 / cos2_alpha)
+            C = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+            lam_prev = lam
+            lam = L + (1 - C) * WGS84_F * sin_alpha * (
+                sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = np.abs(lam - lam_prev) < tol
+            if converged.all():
+                break
+
+        u2 = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+            - B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        distances = WGS84_B * A * (sigma - delta_sigma)
+
+    return distances, ~converged
+
+def geo_distances(points, centers, method='geodesic'):
+    """
+    Distances in km between each point and its center, computed for the whole array at once.
+
+    points: (n, 2) array of (latitude, longitude)
+    centers: a single (latitude, longitude) or an (n, 2) array, one center per point
+    method: 'geodesic' (vectorized ellipsoidal), 'haversine' (spherical) or 'geopy' (reference loop)
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+    centers = np.broadcast_to(centers, points.shape)
+
+    if method == 'geopy':
+        return np.array([geodesic(tuple(p), tuple(c)).km for p, c in zip(points, centers)])
+
+    lat1, lon1 = np.radians(points[:, 0]), np.radians(points[:, 1])
+    lat2, lon2 = np.radians(centers[:, 0]), np.radians(centers[:, 1])
+
+    if method == 'haversine':
+        return _haversine(lat1, lon1, lat2, lon2)
+    if method == 'geodesic':
+        distances, failed = _vincenty(lat1, lon1, lat2, lon2)
+        # Karney's algorithm (geopy) for the few pairs Vincenty can't handle
+        for i in np.flatnonzero(failed):
+            distances[i] = geodesic(tuple(points[i]), tuple(centers[i])).km
+        return distances
+
+    raise ValueError(f"Unknown distance method '{method}', use one of {DISTANCE_METHODS}")
+
+def geo_distance_matrix(points, others=None, method='haversine'):
+    # Point-to-point distances in km, (n, m) matrix between points and others (points itself if None)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    others = points if others is None else np.asarray(others, dtype=np.float64).reshape(-1, 2)
+
+    if method == 'geopy':
+        return np.array([[geodesic(tuple(p), tuple(o)).km for o in others] for p in points])
+
+    lat1, lon1 = np.radians(points[:, 0])[:, np.newaxis], np.radians(points[:, 1])[:, np.newaxis]
+    lat2, lon2 = np.radians(others[:, 0])[np.newaxis, :], np.radians(others[:, 1])[np.newaxis, :]
+
+    if method == 'haversine':
+        return _haversine(lat1, lon1, lat2, lon2)
+    if method == 'geodesic':
+        distances, failed = _vincenty(lat1, lon1, lat2, lon2)
+        for i, j in zip(*np.nonzero(failed)):
+            distances[i, j] = geodesic(tuple(points[i]), tuple(others[j])).km
+        return distances
+
+    raise ValueError(f"Unknown distance method '{method}', use one of {DISTANCE_METHODS}")
 
 # Calculate the radius of a cluster
-def calculate_radius2(cluster_points, center, points):
+def calculate_radius2(cluster_points, center, points, method='geodesic'):
     
-    distances = [geodesic((lat, lon), center).km for lat, lon in cluster_points]
+    distances = geo_distances(cluster_points, center, method)
     
     # Find the maximum distance and its index
-    max_distance = max(distances)
-    max_distance_index = distances.index(max_distance)
+    max_distance_index = int(np.argmax(distances))
+    max_distance = distances[max_distance_index]
     
     # Get the point and corresponding coordinates (lat, lon)
     max_point = points[max_distance_index]  # Assuming 'points' contains the actual data/points for each location
@@ -18,29 +128,181 @@ def calculate_radius2(cluster_points, center, points):
     
     return max_distance, max_point, corresponding_coords
 
-def calculate_distances(cluster_points, center):
-    distances = [geodesic((lat, lon), center).km for lat, lon in cluster_points]
+def calculate_distances(cluster_points, center, method='geodesic'):
+    distances = geo_distances(cluster_points, center, method)
     return distances
 
-# Haversine formula
-def haversine_matrix(df):
+# Haversine formula, computed in blocks of rows so peak memory stays around block_size x N
+def haversine_matrix(df, block_size=1024, dtype=np.float64, out=None, max_distance=None):
+    """
+    Haversine distance matrix (km) between all the locations of df.
+
+    out: optional preallocated (N, N) array to fill, e.g. a np.lib.format.open_memmap file
+    max_distance: if given, return a sparse CSR matrix holding only the pairs within max_distance km
+    """
     locations = np.radians(df[['latitude', 'longitude']].to_numpy()) #convert longitude/latitude in radians
-    latitudes = locations[:, 0][:, np.newaxis]
-    longitudes = locations[:, 1][:, np.newaxis]
-    dlat = latitudes - latitudes.T
-    dlon = longitudes - longitudes.T
-    a = np.sin(dlat / 2) ** 2 + np.cos(latitudes) * np.cos(latitudes.T) * np.sin(dlon / 2) ** 2
-    c = 2 * np.arcsin(np.sqrt(a))
-    earth_radius = 6378  # Radius of the Earth in km
-    return earth_radius * c
+    latitudes = locations[:, 0]
+    longitudes = locations[:, 1]
+    n = len(locations)
+
+    if max_distance is None:
+        if out is None:
+            out = np.empty((n, n), dtype=dtype)
+        elif out.shape != (n, n):
+            raise ValueError(f"out must have shape {(n, n)}, got {out.shape}")
+    else:
+        rows, cols, values = [], [], []
+
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block = _haversine(latitudes[start:stop, np.newaxis], longitudes[start:stop, np.newaxis],
+                           latitudes[np.newaxis, :], longitudes[np.newaxis, :])
+        if max_distance is None:
+            out[start:stop] = block
+        else:
+            block_rows, block_cols = np.nonzero(block <= max_distance)
+            rows.append(block_rows + start)
+            cols.append(block_cols)
+            values.append(block[block_rows, block_cols].astype(dtype))
+
+    if max_distance is None:
+        return out
+
+    rows, cols, values = (np.concatenate(x) if x else np.empty(0) for x in (rows, cols, values))
+    return sparse.csr_matrix((values, (rows, cols)), shape=(n, n), dtype=dtype)
+
+#SPATIAL INDEX
+
+class SpatialIndex:
+    """
+    BallTree (haversine metric) over POS coordinates for k-nearest, radius and nearest-centroid queries.
+
+    Added POS go to a small buffer searched by brute force and removed POS are masked out,
+    the tree is rebuilt only when they exceed rebuild_fraction of the indexed points.
+    """
+
+    def __init__(self, df, leaf_size=40, rebuild_fraction=0.1):
+        self.leaf_size = leaf_size
+        self.rebuild_fraction = rebuild_fraction
+        self._build(df['location_id'].to_numpy(), np.radians(df[['latitude', 'longitude']].to_numpy(dtype=np.float64)))
+
+    @classmethod
+    def from_csv(cls, path='./Data/spatial_data.csv', **kwargs):
+        return cls(pd.read_csv(path, usecols=['location_id', 'latitude', 'longitude']), **kwargs)
+
+    def _build(self, location_ids, coords):
+        self.tree_ids = location_ids
+        self.tree_coords = coords
+        self.alive = np.ones(len(location_ids), dtype=bool)
+        self.tree = BallTree(coords, leaf_size=self.leaf_size, metric='haversine')
+        self.buffer_ids = location_ids[:0]
+        self.buffer_coords = np.empty((0, 2))
+
+    def __len__(self):
+        return int(self.alive.sum()) + len(self.buffer_ids)
+
+    def location_ids(self):
+        return np.concatenate([self.tree_ids[self.alive], self.buffer_ids])
+
+    def coordinates(self):
+        # (latitude, longitude) in degrees, same order as location_ids()
+        return np.degrees(np.concatenate([self.tree_coords[self.alive], self.buffer_coords]))
+
+    def rebuild(self):
+        self._build(self.location_ids(), np.radians(self.coordinates()))
+
+    def _maybe_rebuild(self):
+        pending = len(self.buffer_ids) + int((~self.alive).sum())
+        if pending > self.rebuild_fraction * max(len(self.tree_ids), 1):
+            self.rebuild()
+
+    def add(self, df):
+        self.buffer_ids = np.concatenate([self.buffer_ids, df['location_id'].to_numpy()])
+        self.buffer_coords = np.concatenate([self.buffer_coords, np.radians(df[['latitude', 'longitude']].to_numpy(dtype=np.float64))])
+        self._maybe_rebuild()
+
+    def remove(self, location_ids):
+        self.alive &= ~np.isin(self.tree_ids, location_ids)
+        keep = ~np.isin(self.buffer_ids, location_ids)
+        self.buffer_ids, self.buffer_coords = self.buffer_ids[keep], self.buffer_coords[keep]
+        self._maybe_rebuild()
+
+    def _buffer_distances(self, points):
+        # Brute force over the (small) buffer, in km
+        return _haversine(points[:, 0][:, np.newaxis], points[:, 1][:, np.newaxis],
+                          self.buffer_coords[:, 0][np.newaxis, :], self.buffer_coords[:, 1][np.newaxis, :])
+
+    def query_knn(self, points, k=1):
+        # k nearest POS of every (latitude, longitude) point: (distances in km, location_ids), both (m, k)
+        points = np.radians(np.asarray(points, dtype=np.float64).reshape(-1, 2))
+        n_dead = int((~self.alive).sum())
+        k_tree = min(k + n_dead, len(self.tree_ids))
+
+        if k_tree:
+            distances, positions = self.tree.query(points, k=k_tree)
+            distances = np.where(self.alive[positions], distances * EARTH_RADIUS, np.inf)
+            ids = self.tree_ids[positions]
+        else:
+            distances, ids = np.empty((len(points), 0)), np.empty((len(points), 0), dtype=self.tree_ids.dtype)
+
+        if len(self.buffer_ids):
+            distances = np.hstack([distances, self._buffer_distances(points)])
+            ids = np.hstack([ids, np.broadcast_to(self.buffer_ids, (len(points), len(self.buffer_ids)))])
+
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    def query_radius(self, points, radius):
+        # POS within radius km of every point: lists of (location_ids, distances in km) arrays
+        points = np.radians(np.asarray(points, dtype=np.float64).reshape(-1, 2))
+        positions, distances = self.tree.query_radius(points, r=radius / EARTH_RADIUS, return_distance=True)
+        buffer_distances = self._buffer_distances(points) if len(self.buffer_ids) else None
+
+        results = []
+        for i, (pos, dist) in enumerate(zip(positions, distances)):
+            alive = self.alive[pos]
+            ids, dist = self.tree_ids[pos[alive]], dist[alive] * EARTH_RADIUS
+            if buffer_distances is not None:
+                close = buffer_distances[i] <= radius
+                ids = np.concatenate([ids, self.buffer_ids[close]])
+                dist = np.concatenate([dist, buffer_distances[i][close]])
+            results.append((ids, dist))
+        return results
+
+    def nearest_centroid(self, centers, points=None):
+        # Index of the nearest center (and distance in km) for the given points, or every indexed POS
+        points = self.coordinates() if points is None else np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        centers_tree = BallTree(np.radians(np.asarray(centers, dtype=np.float64).reshape(-1, 2)), metric='haversine')
+        distances, nearest = centers_tree.query(np.radians(points), k=1)
+        return nearest[:, 0], distances[:, 0] * EARTH_RADIUS
+
+# Outliers as DBSCAN noise (label -1), neighbourhoods from the spatial index instead of all-pairs distances
+def detect_outliers_dbscan(df, eps_km, min_samples, index=None):
+
+    if index is None:
+        index = SpatialIndex(df)
+
+    coords = df[['latitude', 'longitude']].to_numpy(dtype=np.float64)
+    neighbours = index.query_radius(coords, eps_km)
+    rows = np.repeat(np.arange(len(df)), [len(ids) for ids, _ in neighbours])
+    cols = pd.Index(df['location_id'].to_numpy()).get_indexer(np.concatenate([ids for ids, _ in neighbours]))
+    values = np.concatenate([dist for _, dist in neighbours])
+    keep = cols >= 0
+    graph = sparse.csr_matrix((values[keep], (rows[keep], cols[keep])), shape=(len(df), len(df)))
+
+    labels = DBSCAN(eps=eps_km, min_samples=min_samples, metric='precomputed').fit_predict(graph)
+    return labels == -1, labels
 
 def create_cluster_summary(data):
     
     # Group by the 'cluster'
-    cluster_summary = data.groupby('cluster').agg({
+    aggregations = {
         'location_id': lambda x: list(x), # list of location_ids
         'cluster_center': 'first'  # Cluster center longitude/latitude
-    }).reset_index()
+    }
+    if 'quantity' in data.columns:
+        aggregations['quantity'] = 'sum'  # hub total quantity, the demand of line-haul routing
+    cluster_summary = data.groupby('cluster').agg(aggregations).reset_index()
 
     # modify the new dataframe
     cluster_summary[['latitude', 'longitude']] = pd.DataFrame(cluster_summary['cluster_center'].tolist(), index=cluster_summary.index)
@@ -50,12 +312,39 @@ def create_cluster_summary(data):
     return cluster_summary
 
 
-def haversine_matrix_hubs(data, hubs):
-    
-    kmeans = KMeans(n_clusters=hubs,
-                    random_state=0,  # to allow reproducibility
-                    n_init=10,
-                    max_iter=300)
+# Starting centers for a new hub count from the previous hubs' centers, POS taken from the spatial index
+def seed_hub_centers(index, previous_centers, hubs):
+    previous_centers = np.asarray(previous_centers, dtype=np.float64)
+    nearest_hub, nearest = index.nearest_centroid(previous_centers)
+    if hubs <= len(previous_centers):
+        # Fewer hubs: merge the previous centers, weighted by the points each of them serves
+        served = np.bincount(nearest_hub, minlength=len(previous_centers))
+        return KMeans(n_clusters=hubs, random_state=0, n_init=10).fit(previous_centers, sample_weight=served).cluster_centers_
+    # More hubs: add points k-means++ style, with probability proportional to the squared distance
+    # from the centers chosen so far
+    rng = np.random.default_rng(0)
+    points = index.coordinates()
+    centers = list(previous_centers)
+    while len(centers) < hubs:
+        chosen = rng.choice(len(points), p=nearest ** 2 / np.sum(nearest ** 2))
+        centers.append(points[chosen])
+        nearest = np.minimum(nearest, geo_distances(points, points[chosen], 'haversine'))
+    return np.array(centers)
+
+def haversine_matrix_hubs(data, hubs, init_centers=None, index=None):
+    """
+    init_centers: hub centers of a previous fit (e.g. its cluster_df[['latitude', 'longitude']]);
+    when given, KMeans runs once from centers seeded from them instead of 10 k-means++ inits.
+    index: SpatialIndex over the POS of data, reused across refits (built from data if None)
+    """
+    if init_centers is None:
+        kmeans = KMeans(n_clusters=hubs,
+                        random_state=0,  # to allow reproducibility
+                        n_init=10,
+                        max_iter=300)
+    else:
+        seeds = seed_hub_centers(index or SpatialIndex(data), init_centers, hubs)
+        kmeans = KMeans(n_clusters=hubs, init=seeds, n_init=1, max_iter=300)
 
     data['cluster'] = kmeans.fit_predict(data[['latitude', 'longitude']])
 
@@ -65,17 +354,9 @@ def haversine_matrix_hubs(data, hubs):
 
     cluster_df = create_cluster_summary(data)
 
-    locations = np.radians(cluster_df[['latitude', 'longitude']].to_numpy())  # convert longitude/latitude in radians
-    latitudes = locations[:, 0][:, np.newaxis]
-    longitudes = locations[:, 1][:, np.newaxis]
-    dlat = latitudes - latitudes.T
-    dlon = longitudes - longitudes.T
-    a = np.sin(dlat / 2) ** 2 + np.cos(latitudes) * np.cos(latitudes.T) * np.sin(dlon / 2) ** 2
-    c = 2 * np.arcsin(np.sqrt(a))
-    earth_radius = 6378  # Radius of the Earth in km
-    return earth_radius * c, cluster_df
+    return haversine_matrix(cluster_df), cluster_df
 
-def cluster_statistics(clustered_data):
+def cluster_statistics(clustered_data, method='geodesic'):
     
     # Group by cluster
     cluster_groups = clustered_data.groupby('cluster')
@@ -95,12 +376,12 @@ def cluster_statistics(clustered_data):
     distance_stats = []
     for cluster, group in cluster_groups:
         center = group['cluster_center'].iloc[0]  # centroid
-        cluster_points = list(zip(group['latitude'], group['longitude']))  # List of (latitude, longitude) tuples
-        distances = calculate_distances(cluster_points, center)
+        cluster_points = group[['latitude', 'longitude']].values  # (latitude, longitude) pairs
+        distances = calculate_distances(cluster_points, center, method)
         
-        max_distance = max(distances)
-        min_distance = min(distances)
-        avg_distance = sum(distances) / len(distances)
+        max_distance = distances.max()
+        min_distance = distances.min()
+        avg_distance = distances.mean()
         
         distance_stats.append({
             'cluster': cluster,
@@ -154,7 +435,7 @@ def get_cluster_stats(data2):
         
         return current_max_points, current_max_quantity, cluster_quantity_sum, cluster_sizes, quantity_stats
 
-def get_cluster_stats_radius(data3):
+def get_cluster_stats_radius(data3, method='geodesic'):
 
         clusters = data3['cluster'].unique()
         clusters_maxradius=[]
@@ -166,7 +447,7 @@ def get_cluster_stats_radius(data3):
             
             cluster_data = data3[data3['cluster'] == cluster_id]
             center = cluster_data['cluster_center'].iloc[0]
-            radius, max_point, corresponding_coords = calculate_radius2(cluster_data[['latitude', 'longitude']].values, center, cluster_data['location_id'].values)
+            radius, max_point, corresponding_coords = calculate_radius2(cluster_data[['latitude', 'longitude']].values, center, cluster_data['location_id'].values, method)
             
             clusters_maxradius.append(radius)
             clusters_maxpoint.append(max_point)
@@ -186,33 +467,106 @@ def get_cluster_stats_radius(data3):
         return current_max_radius, clusters_radius
 
 
-def calculate_sse(final_cluster):
+def calculate_sse(final_cluster, method='geodesic'):
     """
     Calculate the Sum of Squared Errors (SSE) for a clustering result.
     
     """
-    sse = 0.0
-    for _, row in final_cluster.iterrows():
-        # Get the latitude and longitude of the data point
-        point = (row['latitude'], row['longitude'])
-        # Get the cluster center (latitude, longitude) for the assigned cluster
-        center = row['cluster_center']
-        
-        # Calculate the squared distance between the point and the cluster center
-        distance = geodesic(point, center).km  # Calculate distance in kilometers
-        squared_distance = distance ** 2       # Square the distance
-        
-        # Add to SSE
-        sse += squared_distance
+    # Latitude/longitude of every data point and of its assigned cluster center
+    points = final_cluster[['latitude', 'longitude']].to_numpy()
+    centers = np.array(final_cluster['cluster_center'].tolist(), dtype=np.float64)
+
+    # Squared distances (km) between points and centers, summed
+    distances = geo_distances(points, centers, method)
+    sse = float(np.sum(distances ** 2))
         
     return sse
 
+#OD MATRIX STORE
+
+class ODMatrix:
+    """
+    Origin-destination matrix indexed by location_id.
+
+    Every location_id is mapped to its row/column position once, so a cluster's
+    submatrix is a single fancy-indexed slice of the underlying array.
+    """
+
+    def __init__(self, matrix, row_ids, col_ids=None, version=None):
+        self.matrix = matrix
+        self.rows = pd.Index(np.asarray(row_ids).astype(str))
+        self.cols = self.rows if col_ids is None else pd.Index(np.asarray(col_ids).astype(str))
+        self._version = version
+
+    @property
+    def version(self):
+        """
+        Fingerprint of ids and values; results derived from the matrix are cached under it.
+
+        Without a version given, the first access hashes the whole matrix (N x N values, GBs for
+        tens of thousands of POS). Pass version= (load_od_matrix uses the file's size/mtime) to skip it.
+        """
+        if self._version is None:
+            self._version = fingerprint(self.rows.tolist(), self.cols.tolist(), np.asarray(self.matrix))
+        return self._version
+
+    @classmethod
+    def from_frame(cls, filtered_matrix, version=None):
+        # Frame rows labelled by location_id and columns by str(location_id), as loaded from Data/OD_Matrix.
+        # to_numpy() is a view for a single-dtype frame, the parent matrix isn't copied
+        return cls(filtered_matrix.to_numpy(), filtered_matrix.index, filtered_matrix.columns, version)
+
+    def positions(self, location_ids):
+        keys = np.asarray(location_ids).astype(str)
+        row_pos = self.rows.get_indexer(keys)
+        col_pos = self.cols.get_indexer(keys)
+        missing = (row_pos < 0) | (col_pos < 0)
+        if missing.any():
+            raise KeyError(f"location_id not in the OD matrix: {keys[missing].tolist()}")
+        return row_pos, col_pos
+
+    def submatrix(self, location_ids):
+        row_pos, col_pos = self.positions(location_ids)
+        # Only the selected cells are read, which matters when matrix is memory-mapped
+        return np.asarray(self.matrix[np.ix_(row_pos, col_pos)])
+
+# Binary OD layout: matrix.npy (memory-mapped, float32/int32) + row_ids.npy / col_ids.npy sidecars
+def convert_od_matrix(csv_path, out_dir, dtype='float32', chunksize=2000):
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Column ids from the header, row count from a raw line scan (no parsing)
+    col_ids = pd.read_csv(csv_path, index_col=0, nrows=0).columns.to_numpy().astype(str)
+    with open(csv_path) as f:
+        n_rows = sum(1 for line in f if line.strip()) - 1
+
+    matrix = np.lib.format.open_memmap(os.path.join(out_dir, 'matrix.npy'), mode='w+',
+                                       dtype=dtype, shape=(n_rows, len(col_ids)))
+    row_ids = []
+    start = 0
+    # Stream the CSV, only one chunk of rows is parsed in memory at a time
+    for chunk in pd.read_csv(csv_path, index_col=0, chunksize=chunksize):
+        matrix[start:start + len(chunk)] = chunk.to_numpy(dtype=dtype)
+        row_ids.append(chunk.index.to_numpy().astype(str))
+        start += len(chunk)
+    matrix.flush()
+
+    np.save(os.path.join(out_dir, 'row_ids.npy'), np.concatenate(row_ids))
+    np.save(os.path.join(out_dir, 'col_ids.npy'), col_ids)
+    return out_dir
+
+# Load a converted OD matrix (e.g. Data/OD_Matrix or Data/OD_Time_Matrix), nothing is read until sliced
+def load_od_matrix(od_dir):
+    matrix = np.load(os.path.join(od_dir, 'matrix.npy'), mmap_mode='r')
+    row_ids = np.load(os.path.join(od_dir, 'row_ids.npy'))
+    col_ids = np.load(os.path.join(od_dir, 'col_ids.npy'))
+    # Version from the file's size/mtime, so the memory-mapped values are never read just to hash them
+    stat = os.stat(os.path.join(od_dir, 'matrix.npy'))
+    version = fingerprint(row_ids, col_ids, stat.st_size, stat.st_mtime_ns)
+    return ODMatrix(matrix, row_ids, col_ids, version)
+
 # Build distance matrix for OR-Tools
 def create_distance_matrix(cluster_locations, filtered_matrix):
-    distance_matrix = []
-    for loc_id_from in cluster_locations:
-        row = []
-        for loc_id_to in cluster_locations:
-            row.append(filtered_matrix[str(loc_id_to)].loc[loc_id_from])
-        distance_matrix.append(row)
-    return distance_matrix
\ No newline at end of file
+    if not isinstance(filtered_matrix, ODMatrix):
+        filtered_matrix = ODMatrix.from_frame(filtered_matrix)
+    return filtered_matrix.submatrix(cluster_locations)